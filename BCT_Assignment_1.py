@@ -1,9 +1,14 @@
+import argparse
+import csv
 import json
 import pprint
+import sys
 import time
 from hashlib import sha256
 from json import JSONEncoder
 
+from mining import ProofOfWorkEngine
+
 class Transaction:
     
     def __init__(self,fromAddress,toAddress,amount,timestamp):
@@ -46,19 +51,28 @@ class Block:
         self.previous_hash = previous_hash
         self.nonce = nonce
         
+    def serialize(self):
+        """
+        Returns the string that is hashed by `compute_hash`.
+        """
+        return json.dumps(self.__dict__, sort_keys=True, indent=4, cls=BlockEncoder)
+
     def compute_hash(self):
         """
         Creates a SHA-256 hash of a Block
         :param block: Block.
         """
-        block_string = json.dumps(self.__dict__, sort_keys=True, indent=4, cls=BlockEncoder)
-        return sha256(block_string.encode()).hexdigest()
+        return sha256(self.serialize().encode()).hexdigest()
 
 class Blockchain:
     # difficulty of our PoW algorithm.
     # should be choosed accordingly.
     difficulty = 2
 
+    # engine used by `proof_of_work`, can be replaced by any object
+    # with a `solve(block, difficulty)` method.
+    engine = ProofOfWorkEngine()
+
     def __init__(self):
         """
         Constructor for the `Blockchain` class.
@@ -117,14 +131,10 @@ class Blockchain:
         """
         Function that tries different values of nonce to get a hash
         that satisfies our difficulty criteria, which we set according to the need.
+        The search itself is done by `Blockchain.engine`, the achieved
+        hash rate is available from `Blockchain.engine.stats()`.
         """
-        block.nonce = 0
-        computed_hash = block.compute_hash()
-        while not computed_hash.startswith('0' * Blockchain.difficulty):
-            block.nonce += 1
-            computed_hash = block.compute_hash()
-
-        return computed_hash
+        return Blockchain.engine.solve(block, Blockchain.difficulty)
 
     def add_new_transaction(self, transaction):
         """
@@ -133,30 +143,33 @@ class Blockchain:
         """
         self.unconfirmed_transactions.append(transaction)
 
-    def mine(self):
+    def mine(self, max_transactions=None):
         """
         This function serves as an interface to add the pending
         transactions to the blockchain by adding them to the block
         and figuring out Proof Of Work.
+        :param max_transactions: Maximum number of transactions in the
+                                 block, the others stay pending.
         """
         if not self.unconfirmed_transactions:
             return False
 
         last_block = self.last_block
+        transactions = self.unconfirmed_transactions[:max_transactions]
         
         # creating new block which will all unconfirmed transactions.
         # will be added after the last block in the blockchain.
         
         new_block = Block(last_block.index + 1,
-                          self.unconfirmed_transactions,
+                          transactions,
                           time.time(),
                           last_block.hash)
 
         proof = self.proof_of_work(new_block)
         self.add_block(new_block, proof)
 
-        # clearing all the pending transactions as added to the block.
-        self.unconfirmed_transactions = []
+        # clearing the pending transactions added to the block.
+        self.unconfirmed_transactions = self.unconfirmed_transactions[len(transactions):]
         return new_block.index
     
     def check_chain_validity(cls, chain):
@@ -206,11 +219,91 @@ def print_chain(chain):
         print(json.dumps(x.__dict__, indent=4 , cls=BlockChainEncoder))
     print("]")
 
-if  __name__ == "__main__":
-    
-    #creating our blockchain.
-    myBlockchain = Blockchain()
-    
+def read_transactions(path, file_format=None):
+    """
+    Yields the transactions of a file one at a time, so files larger
+    than the memory can be replayed. The file is either CSV with a
+    header row or newline-delimited JSON, by default depending on its
+    extension. The fields are fromAddress, toAddress, amount and an
+    optional timestamp, the time of reading by default.
+    :param path: Path of the file, - for the standard input.
+    :param file_format: "csv" or "ndjson".
+    """
+    if file_format is None:
+        file_format = "csv" if path.lower().endswith(".csv") else "ndjson"
+    stream = sys.stdin if path == "-" else open(path, newline="")
+    try:
+        if file_format == "csv":
+            records = csv.DictReader(stream)
+        else:
+            records = (json.loads(line) for line in stream if line.strip())
+        for record in records:
+            amount = float(record["amount"])
+            timestamp = record.get("timestamp")
+            yield {
+                "fromAddress": record["fromAddress"],
+                "toAddress": record["toAddress"],
+                "amount": int(amount) if amount.is_integer() else amount,
+                "timestamp": float(timestamp) if timestamp else time.time()
+            }
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+def export_chain(chain, path):
+    """
+    Writes the chain to a file as newline-delimited JSON, one block per
+    line, without serializing the whole chain at once.
+    """
+    with open(path, "w") as export_file:
+        for block in chain:
+            export_file.write(json.dumps(block.__dict__, cls=BlockEncoder))
+            export_file.write("\n")
+
+def bulk_replay(blockchain, transactions, block_size):
+    """
+    Adds the transactions to the blockchain, mining a block every
+    `block_size` transactions and one with the remaining ones.
+    Returns the throughput statistics of the replay.
+    """
+    started = time.perf_counter()
+    mining_time = 0.0
+    hashes = 0
+    count = 0
+    blocks = 0
+
+    def mine_pending():
+        nonlocal mining_time, hashes, blocks
+        mining_started = time.perf_counter()
+        index = blockchain.mine(block_size)
+        mining_time += time.perf_counter() - mining_started
+        hashes += Blockchain.engine.stats()["hashes"]
+        blocks += index is not False
+
+    for transaction in transactions:
+        blockchain.add_new_transaction(transaction)
+        count += 1
+        if len(blockchain.unconfirmed_transactions) >= block_size:
+            mine_pending()
+    while blockchain.unconfirmed_transactions:
+        mine_pending()
+
+    elapsed = time.perf_counter() - started
+    return {"transactions": count,
+            "blocks": blocks,
+            "block_size": block_size,
+            "difficulty": Blockchain.difficulty,
+            "seconds": elapsed,
+            "mining_seconds": mining_time,
+            "transactions_per_second": count / elapsed if elapsed else None,
+            "hashes": hashes,
+            "hashrate": hashes / mining_time if mining_time else None}
+
+def interactive(myBlockchain):
+    """
+    The menu to print the chain, add transactions and mine blocks one
+    at a time.
+    """
     operations = """Choose one of the following operations,
     Enter 1 to print the current blockchain.
     Enter 2 to add a new transaction.
@@ -256,4 +349,36 @@ if  __name__ == "__main__":
                 print("Mined Block is : \n")
                 print(json.dumps(myBlockchain.last_block.__dict__, indent=4, cls=BlockEncoder))       
             
-                
\ No newline at end of file
+                
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Toy blockchain. Without arguments, an interactive menu "
+                    "is shown. With --input, the transactions of a CSV or "
+                    "NDJSON file are replayed into blocks and throughput "
+                    "statistics are printed as JSON.")
+    parser.add_argument("--input", help="file of transactions to replay, - for stdin")
+    parser.add_argument("--format", choices=("csv", "ndjson"),
+                        help="format of the input, by default from its extension")
+    parser.add_argument("--block-size", type=int, default=100,
+                        help="transactions per mined block")
+    parser.add_argument("--difficulty", type=int, default=Blockchain.difficulty)
+    parser.add_argument("--export", help="file to write the chain to, as NDJSON")
+    args = parser.parse_args()
+
+    #creating our blockchain.
+    Blockchain.difficulty = args.difficulty
+    myBlockchain = Blockchain()
+
+    if args.input is None:
+        interactive(myBlockchain)
+        return
+
+    stats = bulk_replay(myBlockchain, read_transactions(args.input, args.format),
+                        max(args.block_size, 1))
+    if args.export:
+        export_chain(myBlockchain.chain, args.export)
+    print(json.dumps(stats, indent=2))
+
+if  __name__ == "__main__":
+    main()
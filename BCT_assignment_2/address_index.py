@@ -0,0 +1,161 @@
+import sqlite3
+import threading
+
+from merkle import transaction_hash
+
+
+def parse_amount(transaction):
+    """
+    Returns the amount of a transaction as a number, or None if it has
+    no valid amount.
+    """
+    try:
+        return float(transaction.get("amount"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AddressIndex:
+    """
+    Index of the transactions of the chain by hash and by address, with
+    the balance of every address.
+    It is kept in an SQLite database and updated block by block as the
+    chain grows, so history and balance queries do not scan the chain.
+    Blocks removed from the chain are reverted with `truncate`.
+    :param path: Path of the database file, ":memory:" for no file.
+    """
+
+    def __init__(self, path=":memory:"):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS blocks (
+                height INTEGER PRIMARY KEY,
+                hash TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS txs (
+                hash TEXT PRIMARY KEY,
+                height INTEGER NOT NULL,
+                position INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS address_txs (
+                address TEXT NOT NULL,
+                height INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                tx_hash TEXT NOT NULL,
+                delta REAL);
+            CREATE INDEX IF NOT EXISTS address_txs_by_address
+                ON address_txs (address, height, position);
+            CREATE INDEX IF NOT EXISTS address_txs_by_height
+                ON address_txs (height);
+            CREATE TABLE IF NOT EXISTS balances (
+                address TEXT PRIMARY KEY,
+                balance REAL NOT NULL);
+        """)
+
+    def __len__(self):
+        """
+        Number of blocks indexed.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT MAX(height) FROM blocks").fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def _block_hash(self, height):
+        row = self._db.execute("SELECT hash FROM blocks WHERE height = ?",
+                               (height,)).fetchone()
+        return row[0] if row else None
+
+    def catch_up(self, chain):
+        """
+        Makes the index match the chain: blocks indexed from another
+        chain are reverted, and the missing blocks are indexed.
+        """
+        height = min(len(self), len(chain))
+        while height and self._block_hash(height - 1) != chain[height - 1].hash:
+            height -= 1
+        self.truncate(height)
+        for block in chain[height:]:
+            self.add_block(block)
+
+    def add_block(self, block):
+        """
+        Indexes the transactions of the block, which must follow the
+        last indexed block.
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO blocks VALUES (?, ?)",
+                             (block.index, block.hash))
+            for position, transaction in enumerate(block.transactions):
+                if not isinstance(transaction, dict):
+                    continue
+                tx_hash = transaction_hash(transaction)
+                self._db.execute("INSERT OR REPLACE INTO txs VALUES (?, ?, ?)",
+                                 (tx_hash, block.index, position))
+                amount = parse_amount(transaction)
+                for address, sign in ((transaction.get("fromAddress"), -1),
+                                      (transaction.get("toAddress"), 1)):
+                    if not address:
+                        continue
+                    delta = None if amount is None else sign * amount
+                    self._db.execute(
+                        "INSERT INTO address_txs VALUES (?, ?, ?, ?, ?)",
+                        (address, block.index, position, tx_hash, delta))
+                    if delta is not None:
+                        self._db.execute(
+                            "INSERT INTO balances VALUES (?, ?) "
+                            "ON CONFLICT (address) DO UPDATE "
+                            "SET balance = balance + excluded.balance",
+                            (address, delta))
+
+    def truncate(self, height):
+        """
+        Reverts the blocks from `height` onwards.
+        """
+        with self._lock, self._db:
+            reverted = self._db.execute(
+                "SELECT address, SUM(delta) FROM address_txs "
+                "WHERE height >= ? AND delta IS NOT NULL GROUP BY address",
+                (height,)).fetchall()
+            for address, delta in reverted:
+                self._db.execute("UPDATE balances SET balance = balance - ? "
+                                 "WHERE address = ?", (delta, address))
+            self._db.execute("DELETE FROM address_txs WHERE height >= ?", (height,))
+            self._db.execute("DELETE FROM txs WHERE height >= ?", (height,))
+            self._db.execute("DELETE FROM blocks WHERE height >= ?", (height,))
+
+    def find_transaction(self, tx_hash):
+        """
+        Returns the (height, position) of a confirmed transaction, or None.
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT height, position FROM txs WHERE hash = ?",
+                (tx_hash,)).fetchone()
+
+    def balance(self, address):
+        with self._lock:
+            row = self._db.execute("SELECT balance FROM balances WHERE address = ?",
+                                   (address,)).fetchone()
+        return row[0] if row else 0.0
+
+    def history(self, address, limit=50, before=None):
+        """
+        Returns the (height, position, tx hash) of the transactions of
+        the address, newest first. `before` is the (height, position)
+        of the last entry of the previous page.
+        """
+        with self._lock:
+            if before is None:
+                rows = self._db.execute(
+                    "SELECT height, position, tx_hash FROM address_txs "
+                    "WHERE address = ? ORDER BY height DESC, position DESC "
+                    "LIMIT ?", (address, limit))
+            else:
+                rows = self._db.execute(
+                    "SELECT height, position, tx_hash FROM address_txs "
+                    "WHERE address = ? AND (height, position) < (?, ?) "
+                    "ORDER BY height DESC, position DESC LIMIT ?",
+                    (address, before[0], before[1], limit))
+            return rows.fetchall()
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,140 @@
+import heapq
+import json
+import threading
+import time
+
+import requests
+
+
+def _timestamp(post):
+    return post["timestamp"]
+
+
+class PostFeed:
+    """
+    The posts of a node's chain, kept in memory newest first, so pages
+    are served without talking to the node. Only the blocks added since
+    the last known tip are downloaded, and merged into the sorted posts.
+    A background thread refreshes the feed as soon as the node reports a
+    new tip, by long polling its /tip endpoint.
+    :param node_address: Address of the node the posts are read from.
+    :param poll_wait: Longest time, in seconds, a long poll waits for a
+                      new tip.
+    :param retry_interval: Time waited after the node failed to answer.
+    """
+
+    def __init__(self, node_address, poll_wait=25.0, retry_interval=5.0):
+        self.node_address = node_address
+        self.poll_wait = poll_wait
+        self.retry_interval = retry_interval
+        self.session = requests.Session()
+        self._posts = []
+        # tip of the node's chain when the posts were last fetched.
+        self._known_tip = None
+        # guards the posts and the known tip.
+        self._lock = threading.Lock()
+        # held during a refresh, so blocks are not downloaded twice.
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts refreshing the feed in the background, unless it already is.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh(self._wait_for_tip())
+            except (requests.RequestException, ValueError, KeyError):
+                time.sleep(self.retry_interval)
+
+    def _wait_for_tip(self):
+        """
+        Returns the tip of the node once it differs from our known tip,
+        or after `poll_wait` seconds.
+        """
+        params = {}
+        if self._known_tip is not None:
+            params = {"known": self._known_tip["hash"], "wait": self.poll_wait}
+        response = self.session.get("{}/tip".format(self.node_address),
+                                    params=params, timeout=self.poll_wait + 5)
+        response.raise_for_status()
+        return json.loads(response.content)
+
+    def refresh(self, tip=None):
+        """
+        Downloads the blocks added to the node's chain since the known
+        tip, or all of them if the node switched to another chain.
+        :param tip: Tip of the node, fetched if not given.
+        """
+        with self._refresh_lock:
+            if tip is None:
+                response = self.session.get("{}/tip".format(self.node_address),
+                                            timeout=10)
+                response.raise_for_status()
+                tip = json.loads(response.content)
+            known_tip = self._known_tip
+            if known_tip is not None and tip["hash"] == known_tip["hash"]:
+                return
+
+            # a pruned node only has the posts of its recent blocks.
+            start = tip.get("pruned_height", 0)
+            extends = False
+            if known_tip is not None:
+                get_block_address = "{}/block/{}".format(self.node_address,
+                                                         known_tip["hash"])
+                if self.session.get(get_block_address, timeout=10).status_code == 200:
+                    start = max(known_tip["length"], start)
+                    extends = True
+
+            content = []
+            get_blocks_address = "{}/blocks".format(self.node_address)
+            position = start
+            while position < tip["length"]:
+                response = self.session.get(get_blocks_address,
+                                            params={"from": position,
+                                                    "to": tip["length"]},
+                                            timeout=30)
+                response.raise_for_status()
+                blocks = json.loads(response.content)["blocks"]
+                if not blocks:
+                    break
+                for block in blocks:
+                    for tx in block["transactions"]:
+                        tx["index"] = block["index"]
+                        tx["hash"] = block["previous_hash"]
+                        content.append(tx)
+                position += len(blocks)
+
+            content.sort(key=_timestamp, reverse=True)
+            with self._lock:
+                if extends:
+                    # both are sorted, the new posts are merged in.
+                    self._posts = list(heapq.merge(content, self._posts,
+                                                   key=_timestamp, reverse=True))
+                else:
+                    self._posts = content
+                # if the chain got shorter meanwhile, it is read again.
+                self._known_tip = tip if position >= tip["length"] else None
+
+    def page(self, number, size):
+        """
+        Returns the posts of the page `number`, counted from 1, of `size`
+        posts each, and the number of pages. The feed is fetched first if
+        it never was.
+        """
+        if self._known_tip is None:
+            try:
+                self.refresh()
+            except (requests.RequestException, ValueError, KeyError):
+                pass
+        with self._lock:
+            pages = max((len(self._posts) + size - 1) // size, 1)
+            start = (min(max(number, 1), pages) - 1) * size
+            return self._posts[start:start + size], pages
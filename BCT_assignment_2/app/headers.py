@@ -0,0 +1,223 @@
+import json
+import threading
+import time
+
+import requests
+
+from block import Block, block_from_dict, decode_target, header_hash
+from mining import difficulty_to_target
+from poet import is_valid_certificate
+
+
+class HeaderChain:
+    """
+    The headers of a node's chain, downloaded from its /headers endpoint
+    and checked against the consensus rules of the nodes, as a light
+    client would. A header is only trusted if it hashes to the hash the
+    node gives, follows the previous trusted header, is timestamped
+    after the median of the last headers and not in the future, and
+    carries its proof: a hash lower than the target scheduled by the
+    retargeting rule, or a wait certificate of one of the `miners`.
+    The hash of a plain block covers its transactions, so its body is
+    downloaded to compute it.
+    When the node switches to another chain, it replaces the trusted
+    headers only if it has more work, and no chain with less than
+    `min_work` is trusted at all. The blocks are compared to these
+    headers, so the node can not make up a block without mining it.
+    :param node_address: Address of the node the headers are read from.
+    :param consensus: "pow" or "poet", as on the nodes.
+    :param miners: Addresses of the proof of elapsed time miners.
+    :param mean_wait: Mean wait of proof of elapsed time, in seconds.
+    :param min_work: Work below which the chain of the node is not trusted.
+    """
+
+    # the consensus rules of the nodes, see `Blockchain`.
+    difficulty = 2
+    block_interval = 10.0
+    retarget_interval = 10
+    max_retarget_factor = 4
+    max_target = difficulty_to_target(1)
+    max_clock_drift = 5.0
+    median_time_blocks = 11
+
+    def __init__(self, node_address, consensus="pow", miners=frozenset(),
+                 mean_wait=10.0, min_work=0):
+        self.node_address = node_address
+        self.consensus = consensus
+        self.miners = miners
+        self.mean_wait = mean_wait
+        self.min_work = min_work
+        self.session = requests.Session()
+        genesis_block = Block(0, [], 0, "0")
+        # the trusted headers, each with the work of the chain up to it.
+        self._headers = [{"index": 0,
+                          "hash": genesis_block.compute_hash(),
+                          "timestamp": 0,
+                          "target": None,
+                          "work": self.block_work(None, None)}]
+        self._lock = threading.Lock()
+
+    def block_work(self, target, certificate):
+        """
+        Expected number of hashes needed to mine a block, see
+        `Blockchain.block_work`.
+        """
+        if certificate is not None:
+            return 1
+        return 2 ** 256 // (target or difficulty_to_target(self.difficulty))
+
+    def next_target(self, parent, header_at):
+        """
+        Returns the target of the header following `parent`, see
+        `Blockchain.next_target`.
+        :param header_at: Returns the header at a given height on the
+                          branch of `parent`.
+        """
+        target = parent["target"] or difficulty_to_target(self.difficulty)
+        height = parent["index"] + 1
+        interval = self.retarget_interval
+        if height % interval or height <= interval:
+            return target
+
+        timespan = parent["timestamp"] - header_at(height - interval)["timestamp"]
+        expected = (interval - 1) * self.block_interval
+        factor = self.max_retarget_factor
+        timespan = min(max(timespan, expected / factor), expected * factor)
+        target = target * round(timespan * 1000) // round(expected * 1000)
+        return min(target, self.max_target)
+
+    def median_time_past(self, parent, header_at):
+        """
+        See `Blockchain.median_time_past`.
+        """
+        first = max(parent["index"] - self.median_time_blocks + 1, 0)
+        timestamps = sorted(header_at(height)["timestamp"]
+                            for height in range(first, parent["index"] + 1))
+        return timestamps[len(timestamps) // 2]
+
+    def check_header(self, header, parent, header_at):
+        """
+        Returns the trusted header following `parent` made from a header
+        sent by the node, with its hash, or None if it is not valid.
+        """
+        block_hash = header.pop("hash")
+        if header.get("index") != parent["index"] + 1 or \
+                header.get("previous_hash") != parent["hash"]:
+            return None
+        try:
+            if "merkle_root" in header:
+                if header_hash(header) != block_hash:
+                    return None
+            elif not self._check_plain_block(header, block_hash):
+                return None
+            target = decode_target(header.get("target"))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        timestamp = header["timestamp"]
+        if not (isinstance(timestamp, (int, float)) and
+                self.median_time_past(parent, header_at) < timestamp <=
+                time.time() + self.max_clock_drift):
+            return None
+        certificate = header.get("certificate")
+        if self.consensus == "poet":
+            if target is not None or not is_valid_certificate(
+                    certificate, parent["hash"], self.mean_wait, self.miners) or \
+                    timestamp < parent["timestamp"] + certificate["wait"]:
+                return None
+        elif certificate is not None or \
+                target != self.next_target(parent, header_at) or \
+                int(block_hash, 16) >= target:
+            return None
+        return {"index": header["index"],
+                "hash": block_hash,
+                "timestamp": timestamp,
+                "target": target,
+                "work": parent["work"] + self.block_work(target, certificate)}
+
+    def _check_plain_block(self, header, block_hash):
+        """
+        Check if the body of the plain block, downloaded from the node,
+        hashes to block_hash and has the header's fields. The hash of a
+        pruned plain block can not be computed again.
+        """
+        response = self.session.get("{}/block/{}".format(self.node_address, block_hash),
+                                    timeout=30)
+        response.raise_for_status()
+        block_data = json.loads(response.content)
+        block = block_from_dict(block_data)
+        return (not block.pruned and block.compute_hash() == block_hash and
+                block.header() == header)
+
+    def _fork_point(self):
+        """
+        Returns the number of our trusted headers the node's chain still
+        has, going back twice as far every time it does not have ours.
+        """
+        height = len(self._headers) - 1
+        step = 1
+        while height > 0:
+            response = self.session.get("{}/headers".format(self.node_address),
+                                        params={"from": height, "count": 1},
+                                        timeout=30)
+            response.raise_for_status()
+            headers = json.loads(response.content)["headers"]
+            if headers and headers[0]["hash"] == self._headers[height]["hash"]:
+                break
+            height = max(height - step, 0)
+            step *= 2
+        return height + 1
+
+    def refresh(self):
+        """
+        Downloads the headers of the node after the last trusted header
+        it has, and trusts them if they are valid and their chain has
+        more work than ours. A header which is not valid ends the chain.
+        """
+        with self._lock:
+            start = self._fork_point()
+            branch = []
+
+            def header_at(height):
+                if height >= start:
+                    return branch[height - start]
+                return self._headers[height]
+
+            valid = True
+            while valid:
+                response = self.session.get("{}/headers".format(self.node_address),
+                                            params={"from": start + len(branch)},
+                                            timeout=30)
+                response.raise_for_status()
+                headers = json.loads(response.content)["headers"]
+                if not headers:
+                    break
+                for header in headers:
+                    checked = self.check_header(header, header_at(start + len(branch) - 1),
+                                                header_at)
+                    if checked is None:
+                        valid = False
+                        break
+                    branch.append(checked)
+
+            if branch and branch[-1]["work"] > self._headers[-1]["work"]:
+                del self._headers[start:]
+                self._headers.extend(branch)
+
+    def is_trusted(self, index, block_hash):
+        """
+        Check if block_hash is the hash of the trusted header at height
+        `index`, refreshing the headers if it is not.
+        """
+        for attempt in range(2):
+            if attempt:
+                try:
+                    self.refresh()
+                except (requests.RequestException, ValueError, KeyError):
+                    return False
+            with self._lock:
+                if self._headers[-1]["work"] >= self.min_work and \
+                        index < len(self._headers) and \
+                        self._headers[index]["hash"] == block_hash:
+                    return True
+        return False
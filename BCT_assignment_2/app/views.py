@@ -1,45 +1,51 @@
 import datetime
 import json
+import time
 
 import requests
 from flask import render_template, redirect, request
 
 from app import app
+from app.feed import PostFeed
+from app.headers import HeaderChain
+from block import header_hash
+from merkle import transaction_hash, verify_proof
 
 # The node with which our application interacts, there can be multiple
 # such nodes as well.
 CONNECTED_NODE_ADDRESS = "http://127.0.0.1:8000"
 
-posts = []
+# number of posts shown per page.
+POSTS_PER_PAGE = 50
 
+# the consensus of the nodes, and with proof of elapsed time its
+# miners and their mean wait, see `Blockchain.consensus`.
+CONSENSUS = "pow"
+POET_MINERS = frozenset()
+POET_MEAN_WAIT = 10.0
 
-def fetch_posts():
-    """
-    Function to fetch the chain from a blockchain node, parse the
-    data and store it locally.
-    """
-    get_chain_address = "{}/chain".format(CONNECTED_NODE_ADDRESS)
-    response = requests.get(get_chain_address)
-    if response.status_code == 200:
-        content = []
-        chain = json.loads(response.content)
-        for block in chain["chain"]:
-            for tx in block["transactions"]:
-                tx["index"] = block["index"]
-                tx["hash"] = block["previous_hash"]
-                content.append(tx)
-
-        global posts
-        posts = sorted(content, key=lambda k: k['timestamp'],
-                       reverse=True)
+# the posts of the node, refreshed in the background.
+feed = PostFeed(CONNECTED_NODE_ADDRESS)
+
+# the headers of the node's chain, checked as they are downloaded.
+headers = HeaderChain(CONNECTED_NODE_ADDRESS, CONSENSUS, POET_MINERS, POET_MEAN_WAIT)
 
 
 @app.route('/')
 def index():
-    fetch_posts()
+    feed.start()
+    if request.args.get("refresh"):
+        try:
+            feed.refresh()
+        except (requests.RequestException, ValueError, KeyError):
+            pass
+    page = request.args.get("page", 1, type=int)
+    posts, pages = feed.page(page, POSTS_PER_PAGE)
     return render_template('index.html',
                            title='Dexter Blockchain',
                            posts=posts,
+                           page=min(max(page, 1), pages),
+                           pages=pages,
                            node_address=CONNECTED_NODE_ADDRESS,
                            readable_time=timestamp_to_string)
 
@@ -52,19 +58,70 @@ def submit_textarea():
     post_content = request.form["content"]
     author = request.form["author"]
 
-    post_object = {
-        'author': author,
-        'content': post_content,
-    }
+    # every non-empty line of the textarea is a transaction.
+    lines = [line.strip() for line in post_content.splitlines() if line.strip()]
+    if len(lines) <= 1:
+        # timestamped here, so the node sees a resubmitted post as a
+        # duplicate.
+        post_object = {
+            'author': author,
+            'content': post_content.strip(),
+            'timestamp': time.time(),
+        }
+
+        # Submit a transaction
+        new_tx_address = "{}/new_transaction".format(CONNECTED_NODE_ADDRESS)
+
+        requests.post(new_tx_address,
+                      json=post_object,
+                      headers={'Content-type': 'application/json'})
+        return redirect('/')
+
+    # Submit all the transactions in a single request
+    batch_address = "{}/transactions/batch".format(CONNECTED_NODE_ADDRESS)
+    timestamp = time.time()
+    body = "".join(json.dumps({'author': author, 'content': line,
+                               'timestamp': timestamp}) + "\n"
+                   for line in lines)
+
+    requests.post(batch_address,
+                  data=body.encode(),
+                  headers={'Content-type': 'application/x-ndjson'})
 
-    # Submit a transaction
-    new_tx_address = "{}/new_transaction".format(CONNECTED_NODE_ADDRESS)
+    return redirect('/')
 
-    requests.post(new_tx_address,
-                  json=post_object,
-                  headers={'Content-type': 'application/json'})
 
-    return redirect('/')
+def verify_transaction(block_index, position):
+    """
+    Verifies that a transaction is part of a block using its Merkle
+    inclusion proof, without downloading the whole block. The header of
+    the proof must be the one at `block_index` of the headers we trust,
+    see `HeaderChain`.
+    Returns the transaction if it is verified, None otherwise.
+    """
+    get_proof_address = "{}/tx_proof/{}/{}".format(CONNECTED_NODE_ADDRESS,
+                                                   block_index, position)
+    response = requests.get(get_proof_address)
+    if response.status_code != 200:
+        return None
+
+    data = json.loads(response.content)
+    header = data["header"]
+    if (header.get("index") != block_index or header_hash(header) != data["hash"] or
+            not headers.is_trusted(block_index, data["hash"])):
+        return None
+
+    tx_hash = transaction_hash(data["transaction"])
+    if not verify_proof(tx_hash, data["proof"], header["merkle_root"]):
+        return None
+    return data["transaction"]
+
+
+@app.route('/verify/<int:block_index>/<int:position>')
+def verify(block_index, position):
+    if verify_transaction(block_index, position) is None:
+        return "Transaction could not be verified", 400
+    return "Transaction is included in block #{}".format(block_index)
 
 
 def timestamp_to_string(epoch_time):
@@ -0,0 +1,215 @@
+"""
+Benchmarks of the hot paths of the node.
+
+Runs every benchmark for a range of block and chain sizes and writes the
+results as JSON, so two versions can be compared:
+
+    $ python benchmark.py --output bench.json
+    $ python benchmark.py --tx-counts 1 100 --chain-lengths 10 100 --repeat 3
+
+The node keeps its files in the working directory, so the benchmarks run
+in a temporary directory.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+START_DIR = os.getcwd()
+sys.path.insert(0, HERE)
+os.chdir(tempfile.mkdtemp(prefix="bct-bench-"))
+
+import node_server
+from block import Block, MerkleBlock
+from node_server import Blockchain, create_chain_from_dump
+
+
+def measure(function, repeat):
+    """
+    Runs `function` `repeat` times and returns timing statistics.
+    `function` may return the number of operations it did, used to
+    compute a rate.
+    """
+    timings = []
+    operations = 1
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+        if isinstance(result, int) and result > 0:
+            operations = result
+    best = min(timings)
+    return {"min": best,
+            "median": statistics.median(timings),
+            "mean": statistics.mean(timings),
+            "repeat": repeat,
+            "ops_per_second": operations / best if best else None}
+
+
+def make_transactions(count):
+    return [{"author": "bench",
+             "content": "alice,bob,{}".format(i),
+             "fromAddress": "alice",
+             "toAddress": "bob",
+             "amount": i,
+             "timestamp": 1600000000.0 + i}
+            for i in range(count)]
+
+
+def make_chain(length, tx_per_block, block_class=Block):
+    """
+    Mines a chain of `length` blocks, genesis included.
+    """
+    blockchain = Blockchain()
+    blockchain.create_genesis_block()
+    for index in range(1, length):
+        # one block every block_interval, so the target does not change.
+        block = block_class(index, make_transactions(tx_per_block),
+                            1600000000.0 + index * Blockchain.block_interval,
+                            blockchain.last_block.hash,
+                            target=blockchain.next_target(blockchain.last_block))
+        proof = Blockchain.proof_of_work(block)
+        blockchain.add_block(block, proof, verify=False)
+    return blockchain
+
+
+def bench_compute_hash(args):
+    results = []
+    for block_class in (Block, MerkleBlock):
+        for count in args.tx_counts:
+            block = block_class(1, make_transactions(count), time.time(), "0" * 64)
+
+            def hash_block():
+                for _ in range(100):
+                    block.compute_hash()
+                return 100
+
+            results.append({"benchmark": "compute_hash",
+                            "params": {"format": block_class.__name__,
+                                       "transactions": count},
+                            "seconds": measure(hash_block, args.repeat)})
+    return results
+
+
+def bench_proof_of_work(args):
+    results = []
+    saved = Blockchain.difficulty
+    try:
+        for block_class in (Block, MerkleBlock):
+            for difficulty in args.difficulties:
+                for count in (args.tx_counts[0], args.tx_counts[-1]):
+                    Blockchain.difficulty = difficulty
+                    hashes = []
+
+                    def mine():
+                        block = block_class(1, make_transactions(count),
+                                            time.time(), "0" * 64)
+                        Blockchain.proof_of_work(block)
+                        hashes.append(Blockchain.engine.last_hashes)
+
+                    timing = measure(mine, args.repeat)
+                    timing["hashrate"] = Blockchain.engine.hashrate
+                    timing["mean_hashes"] = statistics.mean(hashes)
+                    results.append({"benchmark": "proof_of_work",
+                                    "params": {"format": block_class.__name__,
+                                               "difficulty": difficulty,
+                                               "transactions": count},
+                                    "seconds": timing})
+    finally:
+        Blockchain.difficulty = saved
+    return results
+
+
+def bench_chain(args, chains):
+    results = []
+    for length, blockchain in chains.items():
+        chain_dump = [block.to_dict() for block in blockchain.chain]
+
+        def validate():
+            fresh = Blockchain()
+            fresh.create_genesis_block()
+            candidate = list(blockchain.chain)
+            assert fresh.check_chain_validity(candidate)
+            return length
+
+        def rebuild():
+            create_chain_from_dump(chain_dump)
+            return length
+
+        params = {"chain_length": length, "transactions": args.chain_tx}
+        results.append({"benchmark": "check_chain_validity",
+                        "params": params,
+                        "seconds": measure(validate, args.repeat)})
+        results.append({"benchmark": "create_chain_from_dump",
+                        "params": params,
+                        "seconds": measure(rebuild, args.repeat)})
+    return results
+
+
+def bench_endpoints(args, chains):
+    results = []
+    client = node_server.app.test_client()
+    for length, blockchain in chains.items():
+        saved_blockchain = node_server.blockchain
+        node_server.blockchain = blockchain
+        try:
+            for path in ("/chain", "/tip", "/blocks?from=0", "/headers?from=0"):
+                def get():
+                    response = client.get(path)
+                    assert response.status_code == 200
+                    # the body is streamed, read all of it.
+                    response.get_data()
+
+                results.append({"benchmark": "endpoint",
+                                "params": {"path": path.split("?")[0],
+                                           "chain_length": length,
+                                           "transactions": args.chain_tx},
+                                "seconds": measure(get, args.repeat)})
+        finally:
+            node_server.blockchain = saved_blockchain
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tx-counts", type=int, nargs="+", default=[1, 10, 100, 1000],
+                        help="transactions per block for the hashing benchmarks")
+    parser.add_argument("--difficulties", type=int, nargs="+", default=[1, 2, 3],
+                        help="difficulties for the proof of work benchmark")
+    parser.add_argument("--chain-lengths", type=int, nargs="+", default=[10, 100, 500],
+                        help="chain lengths for the validation and endpoint benchmarks")
+    parser.add_argument("--chain-tx", type=int, default=10,
+                        help="transactions per block of the benchmark chains")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="-",
+                        help="file to write the JSON results to, - for stdout")
+    args = parser.parse_args()
+
+    chains = {length: make_chain(length, args.chain_tx)
+              for length in sorted(args.chain_lengths)}
+
+    results = (bench_compute_hash(args) +
+               bench_proof_of_work(args) +
+               bench_chain(args, chains) +
+               bench_endpoints(args, chains))
+    report = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpus": os.cpu_count(),
+              "created": time.time(),
+              "results": results}
+
+    output = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(os.path.join(START_DIR, args.output), "w") as output_file:
+            output_file.write(output)
+
+
+if __name__ == "__main__":
+    main()
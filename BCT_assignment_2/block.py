@@ -0,0 +1,277 @@
+from hashlib import sha256
+import json
+import struct
+
+from merkle import merkle_proof, merkle_root, transaction_hash
+from poet import is_valid_certificate
+
+
+# binary layout of a `MerkleBlock` header: index, timestamp, previous
+# hash, Merkle root and nonce. The nonce comes last, so a miner hashes
+# the rest of the header only once. Blocks which carry a target have
+# its 256-bit big-endian value before the nonce, and blocks with a wait
+# certificate the SHA-256 of its canonical JSON.
+HEADER_FORMAT = struct.Struct("<Qd32s32s")
+NONCE_FORMAT = struct.Struct("<Q")
+
+
+def encode_target(target):
+    """
+    Returns the JSON representation of a target, as 64 hex digits.
+    """
+    return format(target, "064x")
+
+
+def decode_target(target):
+    return None if target is None else int(target, 16)
+
+
+def encode_header(header):
+    """
+    Returns the canonical binary encoding of a `MerkleBlock` header.
+    :param header: Header dict, as returned by `MerkleBlock.header`.
+    """
+    encoded = HEADER_FORMAT.pack(header["index"],
+                                 header["timestamp"],
+                                 bytes.fromhex(header["previous_hash"]),
+                                 bytes.fromhex(header["merkle_root"]))
+    if "target" in header:
+        encoded += bytes.fromhex(header["target"])
+    if "certificate" in header:
+        encoded += sha256(json.dumps(header["certificate"], sort_keys=True).encode()).digest()
+    return encoded + NONCE_FORMAT.pack(header["nonce"])
+
+
+def header_hash(header):
+    """
+    Creates the SHA-256 hash of a `MerkleBlock` from its header alone.
+    """
+    return sha256(encode_header(header)).hexdigest()
+
+
+class Block:
+    """
+        Constructor for the `Block` class.
+        :param index: Unique ID of the block.
+        :param transactions: List of transactions.
+        :param timestamp: Time of generation of the block.
+        :param previos_hash: hash of the previos block.
+        :nonce: Nonce of the block.
+        :param target: The hash of the block must be lower than this
+                       integer. Blocks without a target are checked
+                       against the chain's default difficulty.
+        :param certificate: Wait certificate of a block published with
+                            proof of elapsed time instead of proof of
+                            work, see poet.py.
+        :param pruned: The block has been pruned, see `prune_block_data`.
+        """
+
+    # blocks have a fixed set of fields, `hash` is set once the block
+    # is part of a chain.
+    __slots__ = ("index", "transactions", "timestamp", "previous_hash",
+                 "nonce", "target", "certificate", "pruned", "hash")
+
+    def __init__(self, index, transactions, timestamp, previous_hash, nonce=0,
+                 target=None, certificate=None, pruned=False):
+        self.index = index
+        self.transactions = transactions
+        self.timestamp = timestamp
+        self.previous_hash = previous_hash
+        self.nonce = nonce
+        self.target = target
+        self.certificate = certificate
+        self.pruned = pruned
+
+    def to_dict(self):
+        """
+        Returns the JSON representation of the block.
+        """
+        block_data = {"index": self.index,
+                      "nonce": self.nonce,
+                      "previous_hash": self.previous_hash,
+                      "timestamp": self.timestamp,
+                      "transactions": self.transactions}
+        if self.target is not None:
+            block_data["target"] = encode_target(self.target)
+        if self.certificate is not None:
+            block_data["certificate"] = self.certificate
+        if self.pruned:
+            block_data["pruned"] = True
+        if hasattr(self, "hash"):
+            block_data["hash"] = self.hash
+        return block_data
+
+    def serialize(self):
+        """
+        Returns the string that is hashed by `compute_hash`.
+        """
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def compute_hash(self):
+        """
+        Creates a SHA-256 hash of a Block
+        :param block: Block.
+        """
+        return sha256(self.serialize().encode()).hexdigest()
+
+    def header(self):
+        """
+        Returns the fields of the block without its transactions. The
+        transactions of a plain block are part of its hash, so its
+        header alone can not be used to check the proof.
+        """
+        header = {"index": self.index,
+                  "nonce": self.nonce,
+                  "previous_hash": self.previous_hash,
+                  "timestamp": self.timestamp}
+        if self.target is not None:
+            header["target"] = encode_target(self.target)
+        if self.certificate is not None:
+            header["certificate"] = self.certificate
+        return header
+
+    def has_valid_proof(self, block_hash, target):
+        """
+        Check if block_hash is the hash of the block, is lower than the
+        integer target and commits to the block's transactions.
+        The block must not have its `hash` attribute set.
+        """
+        return (int(block_hash, 16) < target and
+                block_hash == self.compute_hash() and
+                self.has_valid_transactions())
+
+    def has_valid_certificate(self, block_hash, mean_wait, miners):
+        """
+        Check if block_hash is the hash of the block, commits to the
+        block's transactions and the block carries the wait drawn for
+        its miner, one of the registered `miners`, the proof of elapsed
+        time counterpart of `has_valid_proof`.
+        The block must not have its `hash` attribute set.
+        """
+        return (is_valid_certificate(self.certificate, self.previous_hash,
+                                     mean_wait, miners) and
+                block_hash == self.compute_hash() and
+                self.has_valid_transactions())
+
+    def has_valid_transactions(self):
+        """
+        The transactions of a plain block are part of its hash, they
+        only must not appear twice in the block.
+        """
+        tx_hashes = [transaction_hash(tx) for tx in self.transactions]
+        return len(set(tx_hashes)) == len(tx_hashes)
+
+
+class MerkleBlock(Block):
+    """
+    Block whose hash only covers a fixed-size header. The transactions
+    are committed through the Merkle root stored in the header, so the
+    cost of hashing the block does not depend on the number of
+    transactions, and a single transaction can be proven to be part of
+    the block with `merkle_proof`.
+    The header is hashed in its fixed-size binary encoding, see
+    `encode_header`.
+    """
+
+    __slots__ = ("merkle_root",)
+
+    def __init__(self, index, transactions, timestamp, previous_hash, nonce=0,
+                 merkle_root=None, target=None, certificate=None, pruned=False):
+        super().__init__(index, transactions, timestamp, previous_hash, nonce,
+                         target, certificate, pruned)
+        if merkle_root is None:
+            merkle_root = self.compute_merkle_root()
+        self.merkle_root = merkle_root
+
+    def to_dict(self):
+        block_data = super().to_dict()
+        block_data["merkle_root"] = self.merkle_root
+        return block_data
+
+    def tx_hashes(self):
+        return [transaction_hash(tx) for tx in self.transactions]
+
+    def compute_merkle_root(self):
+        return merkle_root(self.tx_hashes())
+
+    def header(self):
+        """
+        Returns the fields of the block which are covered by its hash.
+        """
+        header = super().header()
+        header["merkle_root"] = self.merkle_root
+        return header
+
+    def serialize(self):
+        return encode_header(self.header())
+
+    def compute_hash(self):
+        return sha256(self.serialize()).hexdigest()
+
+    def mining_template(self):
+        """
+        Returns the header bytes before and after the nonce, and the
+        encoding of the nonce, see `ProofOfWorkEngine`.
+        """
+        header = encode_header(self.header())
+        return header[:-8], b"", "u64"
+
+    def has_valid_transactions(self):
+        """
+        Check if the transactions match the Merkle root of the header.
+        An odd node of the tree is paired with itself, so a list ending
+        with its last transactions repeated has the same root as the
+        list without them: a transaction may only appear once.
+        """
+        tx_hashes = self.tx_hashes()
+        return (len(set(tx_hashes)) == len(tx_hashes) and
+                self.merkle_root == merkle_root(tx_hashes))
+
+    def merkle_proof(self, position):
+        """
+        Returns the inclusion proof of the transaction at `position`.
+        """
+        return merkle_proof(self.tx_hashes(), position)
+
+
+def block_from_dict(block_data):
+    """
+    Creates a `Block` or a `MerkleBlock` from its JSON representation.
+    """
+    if "merkle_root" in block_data:
+        return MerkleBlock(block_data["index"],
+                           block_data["transactions"],
+                           block_data["timestamp"],
+                           block_data["previous_hash"],
+                           block_data["nonce"],
+                           block_data["merkle_root"],
+                           decode_target(block_data.get("target")),
+                           block_data.get("certificate"),
+                           block_data.get("pruned", False))
+    return Block(block_data["index"],
+                 block_data["transactions"],
+                 block_data["timestamp"],
+                 block_data["previous_hash"],
+                 block_data["nonce"],
+                 decode_target(block_data.get("target")),
+                 block_data.get("certificate"),
+                 block_data.get("pruned", False))
+
+
+def block_with_hash(block_data):
+    """
+    Creates a block from its JSON representation, keeping its hash.
+    """
+    block = block_from_dict(block_data)
+    block.hash = block_data["hash"]
+    return block
+
+
+def prune_block_data(block_data):
+    """
+    Returns the JSON representation of a block without its transactions,
+    marked as pruned. It keeps the hash of the block, and its Merkle
+    root, so the block still links the chain, but the hash of a pruned
+    plain block can not be computed again.
+    """
+    return dict(block_data, transactions=[], pruned=True)
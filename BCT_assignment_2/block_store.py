@@ -0,0 +1,440 @@
+import json
+import mmap
+import os
+import re
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+
+
+# one record of the height index: offset and length of the block in the
+# segment file, followed by the raw 32 bytes of the block hash.
+HEIGHT_RECORD = 44
+
+# set in the offset of a pruned block, which is then in `headers.dat`.
+PRUNED = 1 << 63
+
+# blocks copied at a time when the segment file is compacted.
+COPY_CHUNK = 1024 * 1024
+
+# one slot of the hash index: raw block hash followed by height + 1,
+# a height of 0 marks an empty slot. The file starts with the number
+# of used slots.
+HASH_SLOT = 40
+HASH_HEADER = 8
+INITIAL_SLOTS = 1024
+
+
+def _open(path):
+    """
+    Opens a file for reading and writing, creating it if needed.
+    """
+    if not os.path.exists(path):
+        open(path, "wb").close()
+    return open(path, "r+b")
+
+
+class BlockStore(Sequence):
+    """
+    Append-only on-disk storage for the blocks of a chain.
+    Blocks are written as JSON to a segment file, `index.idx` maps every
+    height to the position of its block and `hashes.idx` is an open
+    addressing hash table mapping block hashes to heights. Both indexes
+    are memory-mapped, and blocks are only read and decoded when they
+    are accessed, so opening a store does not depend on its length.
+    The store behaves like the list of blocks it replaces, and can be
+    used from several threads. The blocks below `pruned_height` have
+    been rewritten without their body by `prune`.
+    :param directory: Directory holding the store files.
+    :param decode: Function creating a block from its stored dict.
+    :param cache_size: Number of decoded blocks kept in memory.
+    """
+
+    def __init__(self, directory, decode=None, cache_size=256):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.decode = decode or (lambda block_data: block_data)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        # the files and maps are shared, seeks and remaps are serialised.
+        self._lock = threading.RLock()
+
+        self._heights_path = os.path.join(directory, "index.idx")
+        self._pruned_path = os.path.join(directory, "pruned")
+        self._open_data()
+        self._headers = _open(os.path.join(directory, "headers.dat"))
+        self._heights = _open(self._heights_path)
+        self._heights_map = None
+        self._hashes_path = os.path.join(directory, "hashes.idx")
+        self._hashes = None
+        self._hashes_map = None
+        # counts the calls to `truncate`, a prune reading blocks without
+        # the lock checks it did not change meanwhile.
+        self._truncations = 0
+        self._prune_lock = threading.Lock()
+
+        self._recover()
+        self._open_hashes()
+        self.pruned_height = 0
+        if os.path.exists(self._pruned_path):
+            with open(self._pruned_path, "rb") as pruned_file:
+                self.pruned_height = min(int.from_bytes(pruned_file.read(), "little"),
+                                         self._length)
+
+    def _open_data(self):
+        """
+        Opens the segment file. Once compacted by `prune`, it is named
+        after the offset of its first byte, `_base`, and the one with the
+        highest offset replaces the others. A compaction interrupted by a
+        crash leaves a temporary file, which is dropped.
+        """
+        bases = [0]
+        for name in os.listdir(self.directory):
+            match = re.fullmatch(r"blocks-(\d+)\.dat", name)
+            if match:
+                bases.append(int(match.group(1)))
+            elif re.fullmatch(r"blocks-\d+\.dat\.tmp", name):
+                os.remove(os.path.join(self.directory, name))
+        self._base = max(bases)
+        self._data_path = self._segment_path(self._base)
+        for base in bases:
+            if base != self._base and os.path.exists(self._segment_path(base)):
+                os.remove(self._segment_path(base))
+        self._data = _open(self._data_path)
+
+    def _segment_path(self, base):
+        name = "blocks-{}.dat".format(base) if base else "blocks.dat"
+        return os.path.join(self.directory, name)
+
+    def _recover(self):
+        """
+        Drops a partially written record left by a crash, the data is
+        always written before the index that points at it.
+        """
+        size = os.fstat(self._heights.fileno()).st_size
+        self._length = size // HEIGHT_RECORD
+        if size != self._length * HEIGHT_RECORD:
+            self._heights.truncate(self._length * HEIGHT_RECORD)
+        self._data.truncate(self._data_end(self._length))
+
+    def _data_end(self, length):
+        """
+        Returns the end, in the segment file, of the blocks below height
+        `length`. The pruned blocks are a prefix of the chain, and only
+        the blocks above them are in the segment file.
+        """
+        if length:
+            offset, size, _ = self._record(length - 1)
+            if not offset & PRUNED:
+                return offset - self._base + size
+        return 0
+
+    def _open_hashes(self):
+        if not os.path.exists(self._hashes_path):
+            self._build_hashes(INITIAL_SLOTS)
+        self._hashes = open(self._hashes_path, "r+b")
+        self._hashes_map = mmap.mmap(self._hashes.fileno(), 0)
+        self._slots = (len(self._hashes_map) - HASH_HEADER) // HASH_SLOT
+        self._used = int.from_bytes(self._hashes_map[:HASH_HEADER], "little")
+
+    def _build_hashes(self, slots):
+        """
+        Writes a new hash index with the given number of slots from the
+        height index. Stale entries left by `truncate` are dropped.
+        """
+        self._close_hashes()
+        table = bytearray(HASH_HEADER + slots * HASH_SLOT)
+        for height in range(self._length):
+            key = self._record(height)[2]
+            slot = self._probe(table, slots, key)
+            start = HASH_HEADER + slot * HASH_SLOT
+            table[start:start + HASH_SLOT] = key + (height + 1).to_bytes(8, "little")
+        table[:HASH_HEADER] = self._length.to_bytes(HASH_HEADER, "little")
+
+        temporary = self._hashes_path + ".tmp"
+        with open(temporary, "wb") as hashes_file:
+            hashes_file.write(table)
+        os.replace(temporary, self._hashes_path)
+
+    def _close_hashes(self):
+        if self._hashes_map is not None:
+            self._hashes_map.close()
+            self._hashes.close()
+            self._hashes_map = self._hashes = None
+
+    @staticmethod
+    def _probe(table, slots, key):
+        """
+        Returns the slot holding `key`, or the empty slot where it goes.
+        """
+        slot = int.from_bytes(key[:8], "little") & (slots - 1)
+        while True:
+            start = HASH_HEADER + slot * HASH_SLOT
+            stored = table[start:start + 32]
+            if stored == key or not any(table[start + 32:start + HASH_SLOT]):
+                return slot
+            slot = (slot + 1) & (slots - 1)
+
+    def _record(self, height):
+        """
+        Returns (offset, length, raw hash) of the block at `height`.
+        """
+        end = (height + 1) * HEIGHT_RECORD
+        if self._heights_map is None or len(self._heights_map) < end:
+            if self._heights_map is not None:
+                self._heights_map.close()
+            self._heights_map = mmap.mmap(self._heights.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+        record = self._heights_map[end - HEIGHT_RECORD:end]
+        return (int.from_bytes(record[:8], "little"),
+                int.from_bytes(record[8:12], "little"),
+                record[12:])
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[height] for height in range(*item.indices(self._length))]
+
+        with self._lock:
+            if item < 0:
+                item += self._length
+            if not 0 <= item < self._length:
+                raise IndexError("block height out of range")
+
+            if item in self._cache:
+                self._cache.move_to_end(item)
+                return self._cache[item]
+
+            offset, length, _ = self._record(item)
+            if offset & PRUNED:
+                self._headers.seek(offset ^ PRUNED)
+                block_bytes = self._headers.read(length)
+            else:
+                self._data.seek(offset - self._base)
+                block_bytes = self._data.read(length)
+            block = self.decode(json.loads(block_bytes))
+            self._remember(item, block)
+            return block
+
+    def _remember(self, height, block):
+        self._cache[height] = block
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def height_of(self, block_hash):
+        """
+        Returns the height of the block with the given hash, or None.
+        """
+        key = bytes.fromhex(block_hash)
+        with self._lock:
+            start = HASH_HEADER + self._probe(self._hashes_map, self._slots, key) * HASH_SLOT
+            height = int.from_bytes(self._hashes_map[start + 32:start + HASH_SLOT],
+                                    "little") - 1
+            # the entry may point past a truncated chain or to a block
+            # which has been replaced at the same height.
+            if 0 <= height < self._length and self._record(height)[2] == key:
+                return height
+            return None
+
+    def get_by_hash(self, block_hash):
+        with self._lock:
+            height = self.height_of(block_hash)
+            if height is None:
+                return None
+            return self[height]
+
+    def append(self, block):
+        """
+        Writes the block at the end of the store. The block must have
+        its `hash` set.
+        """
+        block_bytes = json.dumps(block.to_dict(), sort_keys=True).encode()
+        with self._lock:
+            self._data.seek(0, os.SEEK_END)
+            offset = self._base + self._data.tell()
+            self._data.write(block_bytes)
+            self._data.flush()
+
+            key = bytes.fromhex(block.hash)
+            height = self._length
+            if (self._used + 1) * 2 > self._slots:
+                self._build_hashes(self._slots * 2)
+                self._open_hashes()
+            slot = self._probe(self._hashes_map, self._slots, key)
+            start = HASH_HEADER + slot * HASH_SLOT
+            if not any(self._hashes_map[start + 32:start + HASH_SLOT]):
+                self._used += 1
+                self._hashes_map[:HASH_HEADER] = self._used.to_bytes(HASH_HEADER, "little")
+            self._hashes_map[start:start + HASH_SLOT] = key + (height + 1).to_bytes(8, "little")
+
+            self._heights.seek(0, os.SEEK_END)
+            self._heights.write(offset.to_bytes(8, "little") +
+                                len(block_bytes).to_bytes(4, "little") + key)
+            self._heights.flush()
+
+            self._length += 1
+            self._remember(height, block)
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+
+    def __delitem__(self, item):
+        """
+        Only the removal of a suffix, `del store[height:]`, is supported.
+        """
+        if not isinstance(item, slice) or item.stop is not None or item.step is not None:
+            raise TypeError("only a suffix of the store can be removed")
+        self.truncate(item.indices(self._length)[0])
+
+    def truncate(self, length):
+        """
+        Removes the blocks from height `length` onwards.
+        """
+        with self._lock:
+            if length >= self._length:
+                return
+            data_end = self._data_end(length)
+            if self._heights_map is not None:
+                self._heights_map.close()
+                self._heights_map = None
+            self._heights.truncate(length * HEIGHT_RECORD)
+            self._data.truncate(data_end)
+            self._length = length
+            self._truncations += 1
+            if self.pruned_height > length:
+                self._set_pruned_height(length)
+            for height in [h for h in self._cache if h >= length]:
+                del self._cache[height]
+
+    def prune(self, height, strip):
+        """
+        Replaces the blocks below `height` by `strip` of their stored
+        dict, which is appended to `headers.dat`, and points their index
+        records at it. The hashes and heights of the blocks do not change.
+        Only the newly pruned blocks are read and written, without holding
+        the lock readers and `append` use, and the segment file is
+        compacted once most of it is pruned, see `_compact`.
+        A prune already running in another thread makes this one return.
+        :param strip: Function returning the pruned dict of a block.
+        """
+        if not self._prune_lock.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                height = min(height, self._length)
+                if height <= self.pruned_height:
+                    return
+                records = [(position,) + self._record(position)
+                           for position in range(self.pruned_height, height)]
+                data_path, base = self._data_path, self._base
+                truncations = self._truncations
+
+            # only the blocks left by a crashed prune are already pruned.
+            records = [record for record in records if not record[1] & PRUNED]
+            pruned = []
+            with open(data_path, "rb") as data_file:
+                for position, offset, length, key in records:
+                    data_file.seek(offset - base)
+                    block_data = strip(json.loads(data_file.read(length)))
+                    pruned.append((position, key,
+                                   json.dumps(block_data, sort_keys=True).encode()))
+
+            # only written by a prune, the new headers are made durable
+            # before the index points at them.
+            self._headers.seek(0, os.SEEK_END)
+            offset = self._headers.tell()
+            self._headers.write(b"".join(block_bytes for _, _, block_bytes in pruned))
+            self._headers.flush()
+            os.fsync(self._headers.fileno())
+
+            with self._lock:
+                if self._truncations != truncations:
+                    return
+                for position, key, block_bytes in pruned:
+                    self._heights.seek(position * HEIGHT_RECORD)
+                    self._heights.write((offset | PRUNED).to_bytes(8, "little") +
+                                        len(block_bytes).to_bytes(4, "little") + key)
+                    offset += len(block_bytes)
+                self._heights.flush()
+                self._set_pruned_height(height)
+                for position in [h for h in self._cache if h < height]:
+                    del self._cache[position]
+            os.fsync(self._heights.fileno())
+            self._compact()
+        finally:
+            self._prune_lock.release()
+
+    def _compact(self):
+        """
+        Copies the blocks above `pruned_height` to a new segment file once
+        the pruned blocks take most of the current one, so the segment
+        file stays within twice the size of the blocks kept whole.
+        The copy is made without the lock, which is only taken to copy the
+        blocks appended meanwhile and to switch files. The new file is
+        renamed into place before the old one is removed, see `_open_data`.
+        """
+        with self._lock:
+            data_size = os.fstat(self._data.fileno()).st_size
+            if self.pruned_height < self._length:
+                start, _, _ = self._record(self.pruned_height)
+                if start & PRUNED:
+                    return
+            else:
+                start = self._base + data_size
+            if (start - self._base) * 2 <= data_size:
+                return
+            data_path, base = self._data_path, self._base
+            truncations = self._truncations
+
+        new_path = self._segment_path(start)
+        with open(data_path, "rb") as source, open(new_path + ".tmp", "wb") as target:
+            source.seek(start - base)
+            self._copy(source, target, base + data_size - start)
+            target.flush()
+            os.fsync(target.fileno())
+
+            with self._lock:
+                if self._truncations != truncations:
+                    target.close()
+                    os.remove(new_path + ".tmp")
+                    return
+                self._copy(source, target, None)
+                target.flush()
+                os.fsync(target.fileno())
+                target.close()
+                os.replace(new_path + ".tmp", new_path)
+                self._data.close()
+                self._data = _open(new_path)
+                self._data_path, self._base = new_path, start
+        os.remove(data_path)
+
+    @staticmethod
+    def _copy(source, target, size):
+        """
+        Copies `size` bytes, or everything left if None, between files.
+        """
+        while size is None or size > 0:
+            chunk = source.read(COPY_CHUNK if size is None else min(size, COPY_CHUNK))
+            if not chunk:
+                return
+            target.write(chunk)
+            if size is not None:
+                size -= len(chunk)
+
+    def _set_pruned_height(self, height):
+        with open(self._pruned_path + ".tmp", "wb") as pruned_file:
+            pruned_file.write(height.to_bytes(8, "little"))
+        os.replace(self._pruned_path + ".tmp", self._pruned_path)
+        self.pruned_height = height
+
+    def close(self):
+        with self._lock:
+            self._close_hashes()
+            if self._heights_map is not None:
+                self._heights_map.close()
+            self._heights.close()
+            self._data.close()
+            self._headers.close()
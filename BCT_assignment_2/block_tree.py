@@ -0,0 +1,83 @@
+from collections import OrderedDict
+
+
+class BlockTree:
+    """
+    The blocks we know of which are not on our main chain.
+    Side branches are kept by hash, so that a branch which ends up with
+    more work than our chain can be switched to by replacing only the
+    blocks after the fork. Orphans are blocks whose parent we have not
+    seen yet, they are kept by the hash of their parent until it arrives.
+    Both are bounded, the oldest entries are dropped first.
+    :param max_blocks: Maximum number of side branch blocks.
+    :param max_orphans: Maximum number of orphan blocks.
+    """
+
+    def __init__(self, max_blocks=1000, max_orphans=100):
+        self.max_blocks = max_blocks
+        self.max_orphans = max_orphans
+        # hash -> block
+        self._blocks = OrderedDict()
+        self._orphans = OrderedDict()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __contains__(self, block_hash):
+        return block_hash in self._blocks or block_hash in self._orphans
+
+    def get(self, block_hash):
+        return self._blocks.get(block_hash)
+
+    def add(self, block):
+        self._blocks[block.hash] = block
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+    def remove(self, blocks):
+        for block in blocks:
+            self._blocks.pop(block.hash, None)
+
+    def prune(self, min_index):
+        """
+        Drops the side branch blocks below `min_index`, which are too far
+        behind our tip to ever be switched to.
+        """
+        for block_hash in [h for h, b in self._blocks.items() if b.index < min_index]:
+            del self._blocks[block_hash]
+
+    @property
+    def orphan_count(self):
+        return len(self._orphans)
+
+    def add_orphan(self, block):
+        self._orphans[block.hash] = block
+        while len(self._orphans) > self.max_orphans:
+            self._orphans.popitem(last=False)
+
+    def pop_children(self, parent_hash):
+        """
+        Removes and returns the orphans whose parent is `parent_hash`.
+        """
+        children = [block for block in self._orphans.values()
+                    if block.previous_hash == parent_hash]
+        for block in children:
+            del self._orphans[block.hash]
+        return children
+
+    def branch(self, block, find_main_block):
+        """
+        Returns the blocks of the side branch ending with `block`, oldest
+        first, starting right after a block of the main chain, or None
+        if the branch does not reach the main chain.
+        :param find_main_block: Returns the main chain block with a
+                                given hash, or None.
+        """
+        branch = [block]
+        while find_main_block(branch[-1].previous_hash) is None:
+            parent = self._blocks.get(branch[-1].previous_hash)
+            if parent is None:
+                return None
+            branch.append(parent)
+        branch.reverse()
+        return branch
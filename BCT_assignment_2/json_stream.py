@@ -0,0 +1,94 @@
+import codecs
+import json
+
+# content type of newline-delimited JSON, one value per line.
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def iter_chunks(stream, chunk_size=64 * 1024):
+    """
+    Yields the content of a binary file-like object in chunks.
+    """
+    return iter(lambda: stream.read(chunk_size), b"")
+
+
+def iter_ndjson(chunks):
+    """
+    Yields the values of newline-delimited JSON, one per line, read from
+    an iterable of byte chunks. Blank lines are skipped.
+    """
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if buffer.strip():
+        yield json.loads(buffer)
+
+
+def iter_json_array(chunks):
+    """
+    Yields the items of a JSON array read from an iterable of byte
+    chunks, as soon as each of them is complete, so the whole array is
+    never held in memory. Raises `ValueError` if it is not an array.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    # what comes next: "[", "item or ]", "item", ", or ]" or "done".
+    expected = "["
+
+    for chunk in _with_end(chunks):
+        final = chunk is None
+        buffer = buffer[position:] + text.decode(chunk or b"", final=final)
+        position = 0
+        while expected != "done":
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position == len(buffer):
+                break
+            char = buffer[position]
+
+            if expected == "[":
+                if char != "[":
+                    raise ValueError("Expected a JSON array")
+                position += 1
+                expected = "item or ]"
+            elif char == "]" and expected in ("item or ]", ", or ]"):
+                position += 1
+                expected = "done"
+            elif expected == ", or ]":
+                if char != ",":
+                    raise ValueError("Expected ',' at {}".format(position))
+                position += 1
+                expected = "item"
+            else:
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    if final:
+                        raise
+                    break
+                # a number at the end of the buffer may continue in the
+                # next chunk.
+                if end == len(buffer) and not final:
+                    break
+                yield item
+                position = end
+                expected = ", or ]"
+
+    if expected != "done":
+        raise ValueError("Unterminated JSON array")
+    if buffer[position:].strip():
+        raise ValueError("Extra data after the JSON array")
+
+
+def _with_end(chunks):
+    """
+    Yields the chunks followed by None.
+    """
+    yield from chunks
+    yield None
@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import json
+import threading
+
+from merkle import transaction_hash
+
+
+def transaction_priority(transaction):
+    """
+    Priority of a transaction in the pool, its optional `fee` field.
+    """
+    try:
+        return float(transaction.get("fee", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class Mempool:
+    """
+    Pool of unconfirmed transactions, indexed by transaction hash.
+    Duplicates are rejected, transactions are ordered by priority and
+    then by arrival, and the pool is capped both in number of
+    transactions and in bytes: when it is full the lowest priority
+    transaction is evicted, or the new one is rejected if it is the
+    lowest itself.
+    The pool is shared by the request threads of the node, every method
+    holds its lock.
+    :param max_transactions: Maximum number of pending transactions.
+    :param max_bytes: Maximum total size of the pending transactions.
+    """
+
+    def __init__(self, max_transactions=100000, max_bytes=64 * 1024 * 1024):
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        # tx hash -> (priority, sequence, size, transaction)
+        self._entries = {}
+        # best first, and worst first, with entries removed lazily.
+        self._best = []
+        self._worst = []
+        self._sequence = itertools.count()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self._entries
+
+    def get(self, tx_hash):
+        with self._lock:
+            entry = self._entries.get(tx_hash)
+        return entry[3] if entry else None
+
+    def add(self, transaction):
+        """
+        Adds a transaction to the pool. Returns its hash, or None if it
+        is a duplicate or the pool is full of higher priority ones.
+        """
+        tx_hash = transaction_hash(transaction)
+        priority = transaction_priority(transaction)
+        size = len(json.dumps(transaction, sort_keys=True))
+        if size > self.max_bytes:
+            return None
+
+        with self._lock:
+            if tx_hash in self._entries:
+                return None
+            return self._insert(tx_hash, transaction, priority, size)
+
+    def add_many(self, transactions):
+        """
+        Adds several transactions under a single acquisition of the lock.
+        Returns the hash of each transaction, or None where it was not
+        added, see `add`.
+        """
+        prepared = [(transaction_hash(transaction),
+                     transaction_priority(transaction),
+                     len(json.dumps(transaction, sort_keys=True)))
+                    for transaction in transactions]
+        results = []
+        with self._lock:
+            for transaction, (tx_hash, priority, size) in zip(transactions, prepared):
+                if tx_hash in self._entries or size > self.max_bytes:
+                    results.append(None)
+                else:
+                    results.append(self._insert(tx_hash, transaction, priority, size))
+        return results
+
+    def _insert(self, tx_hash, transaction, priority, size):
+        sequence = next(self._sequence)
+        while len(self._entries) >= self.max_transactions or \
+                self.size_bytes + size > self.max_bytes:
+            worst = self._peek(self._worst)
+            if worst is None or (priority, -sequence) <= worst[:2]:
+                return None
+            self.remove(worst[2])
+
+        self._entries[tx_hash] = (priority, sequence, size, transaction)
+        self.size_bytes += size
+        heapq.heappush(self._best, (-priority, sequence, tx_hash))
+        heapq.heappush(self._worst, (priority, -sequence, tx_hash))
+        return tx_hash
+
+    def _peek(self, heap):
+        """
+        Returns the top of a heap, dropping the entries of transactions
+        which are not in the pool anymore.
+        """
+        while heap:
+            key = heap[0]
+            entry = self._entries.get(key[2])
+            if entry is not None and entry[1] == abs(key[1]):
+                return key
+            heapq.heappop(heap)
+        return None
+
+    def remove(self, tx_hash):
+        with self._lock:
+            entry = self._entries.pop(tx_hash, None)
+            if entry is None:
+                return False
+            self.size_bytes -= entry[2]
+            # the heaps are rebuilt once most of their entries are stale.
+            if len(self._best) > 2 * len(self._entries) + 64:
+                self._rebuild()
+            return True
+
+    def remove_included(self, transactions):
+        """
+        Removes the transactions which have been included in a block.
+        """
+        tx_hashes = [transaction_hash(transaction) for transaction in transactions]
+        with self._lock:
+            for tx_hash in tx_hashes:
+                self.remove(tx_hash)
+
+    def _rebuild(self):
+        self._best = [(-priority, sequence, tx_hash) for tx_hash, (priority, sequence, _, _)
+                      in self._entries.items()]
+        self._worst = [(priority, -sequence, tx_hash) for tx_hash, (priority, sequence, _, _)
+                       in self._entries.items()]
+        heapq.heapify(self._best)
+        heapq.heapify(self._worst)
+
+    def items(self):
+        """
+        Returns the (hash, transaction) pairs, in no particular order.
+        """
+        with self._lock:
+            return [(tx_hash, entry[3]) for tx_hash, entry in self._entries.items()]
+
+    def ordered(self):
+        """
+        Returns the (hash, transaction) pairs, highest priority first.
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+        entries.sort(key=lambda item: (-item[1][0], item[1][1]))
+        return [(tx_hash, entry[3]) for tx_hash, entry in entries]
+
+    def select(self, max_transactions=None, max_bytes=None):
+        """
+        Picks the highest priority transactions for a new block, at most
+        `max_transactions` of them and `max_bytes` in total. Transactions
+        stay in the pool until they are removed.
+        Returns a list of (hash, transaction) pairs.
+        """
+        selected = []
+        total = 0
+        with self._lock:
+            for key in heapq.nsmallest(max_transactions or len(self._best),
+                                       self._live_best()):
+                tx_hash = key[2]
+                size = self._entries[tx_hash][2]
+                # a transaction which does not fit is skipped, so a large
+                # one does not hold back the smaller ones after it.
+                if max_bytes is not None and total + size > max_bytes:
+                    continue
+                total += size
+                selected.append((tx_hash, self._entries[tx_hash][3]))
+        return selected
+
+    def _live_best(self):
+        for key in self._best:
+            entry = self._entries.get(key[2])
+            if entry is not None and entry[1] == key[1]:
+                yield key
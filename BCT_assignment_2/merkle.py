@@ -0,0 +1,86 @@
+import json
+from hashlib import sha256
+
+
+# root used for a block without transactions.
+EMPTY_ROOT = "0" * 64
+
+
+def transaction_hash(transaction):
+    """
+    Creates a SHA-256 hash of a transaction, this is the leaf of the
+    transaction in the Merkle tree.
+    :param transaction: Transaction dict.
+    """
+    tx_string = json.dumps(transaction, sort_keys=True)
+    return sha256(b"\x00" + tx_string.encode()).hexdigest()
+
+
+def _parent(left, right):
+    """
+    Hash of an inner node. Leaves and inner nodes use different prefixes
+    so an inner node can never be passed off as a transaction.
+    """
+    return sha256(b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def _next_level(level):
+    # an odd node out is paired with itself.
+    if len(level) % 2:
+        level = level + [level[-1]]
+    return [_parent(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+
+
+def merkle_root(tx_hashes):
+    """
+    Computes the Merkle root of a list of transaction hashes.
+    :param tx_hashes: List of hex transaction hashes, in block order.
+    """
+    if not tx_hashes:
+        return EMPTY_ROOT
+
+    level = list(tx_hashes)
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+
+def merkle_proof(tx_hashes, position):
+    """
+    Builds the inclusion proof of the transaction at `position`.
+    The proof is a list of [sibling hash, side] pairs from the leaf up
+    to the root, side tells if the sibling is on the "left" or "right".
+    :param tx_hashes: List of hex transaction hashes, in block order.
+    :param position: Position of the transaction in the block.
+    """
+    if not 0 <= position < len(tx_hashes):
+        raise IndexError("Transaction position out of range")
+
+    proof = []
+    level = list(tx_hashes)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        if position % 2:
+            proof.append([level[position - 1], "left"])
+        else:
+            proof.append([level[position + 1], "right"])
+        level = _next_level(level)
+        position //= 2
+    return proof
+
+
+def verify_proof(tx_hash, proof, root):
+    """
+    Checks that the transaction hash is committed by the Merkle root.
+    :param tx_hash: Hex hash of the transaction.
+    :param proof: Proof returned by `merkle_proof`.
+    :param root: Merkle root stored in the block header.
+    """
+    current = tx_hash
+    for sibling, side in proof:
+        if side == "left":
+            current = _parent(sibling, current)
+        else:
+            current = _parent(current, sibling)
+    return current == root
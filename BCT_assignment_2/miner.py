@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundMiner:
+    """
+    Mines blocks in a background thread, so a request to mine does not
+    wait for the proof of work.
+    Once triggered the miner keeps mining blocks on the current tip until
+    the pool of pending transactions is empty. The search is abandoned
+    and restarted on the new tip as soon as the chain changes, and
+    restarted every `refresh_interval` seconds so that transactions
+    received in the meantime are included in the block.
+    :param blockchain: The `Blockchain` to mine on.
+    :param on_block: Called with every block mined and added to the chain.
+    :param continuous: Mine whenever there are pending transactions,
+                       without waiting for a trigger.
+    :param refresh_interval: Seconds after which an unsolved block is
+                             rebuilt with the latest transactions.
+    :param retry_interval: Seconds waited after mining failed, or when
+                           the pending transactions can not be mined.
+    """
+
+    def __init__(self, blockchain, on_block=None, continuous=False,
+                 refresh_interval=5.0, retry_interval=1.0):
+        self.blockchain = blockchain
+        self.on_block = on_block
+        self.continuous = continuous
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+
+        self.blocks_mined = 0
+        self.restarts = 0
+        self.errors = 0
+        self.last_block = None
+        self._template = None
+        self._started = None
+        self._requested = threading.Event()
+        self._cancel = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        blockchain.listeners.append(self._tip_changed)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="miner",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._requested.set()
+        self._cancel.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def trigger(self):
+        """
+        Asks the miner to mine the pending transactions.
+        Returns False if it was already mining them.
+        """
+        self.start()
+        was_requested = self._requested.is_set()
+        self._requested.set()
+        return not was_requested
+
+    def _tip_changed(self, snapshot):
+        with self._lock:
+            template = self._template
+        if template is not None and template.previous_hash != snapshot.last_block.hash:
+            self._cancel.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if not self.continuous:
+                self._requested.wait()
+            if self._stopped.is_set():
+                break
+
+            try:
+                self._mine_next()
+            except Exception:
+                # the thread is never restarted, it outlives any error.
+                self.errors += 1
+                logger.exception("mining failed")
+                self._stopped.wait(self.retry_interval)
+
+    def _mine_next(self):
+        block = self.blockchain.new_block()
+        if block is None:
+            # nothing left to mine, unless transactions arrived just
+            # before the trigger is cleared.
+            self._requested.clear()
+            if self.blockchain.mempool:
+                self._requested.set()
+                # the pending transactions may not be minable yet, e.g.
+                # we are not a registered miner.
+                self._stopped.wait(self.retry_interval)
+            elif self.continuous:
+                self._stopped.wait(0.5)
+            return
+        self._mine(block)
+
+    def _mine(self, block):
+        self._cancel.clear()
+        with self._lock:
+            self._template = block
+            self._started = time.time()
+        # the tip may have changed while the block was built.
+        if block.previous_hash != self.blockchain.snapshot.last_block.hash:
+            self._cancel.set()
+        timer = threading.Timer(self.refresh_interval, self._cancel.set)
+        timer.daemon = True
+        timer.start()
+        try:
+            proof = self.blockchain.proof_of_work(block, self._cancel)
+        finally:
+            timer.cancel()
+            with self._lock:
+                self._template = None
+
+        if proof is None or not self.blockchain.add_block(block, proof, verify=False):
+            self.restarts += 1
+            return
+        self.blocks_mined += 1
+        self.last_block = block
+        if self.on_block is not None:
+            self.on_block(block)
+
+    def status(self):
+        with self._lock:
+            template = self._template
+            started = self._started
+        status = {"running": self._thread is not None and self._thread.is_alive(),
+                  "mining": template is not None,
+                  "requested": self._requested.is_set() or self.continuous,
+                  "pending_transactions": len(self.blockchain.mempool),
+                  "blocks_mined": self.blocks_mined,
+                  "restarts": self.restarts,
+                  "errors": self.errors,
+                  "last_block": None,
+                  "template": None,
+                  "engine": type(self.blockchain).engine.stats()}
+        if self.last_block is not None:
+            status["last_block"] = {"index": self.last_block.index,
+                                    "hash": self.last_block.hash}
+        if template is not None:
+            status["template"] = {"index": template.index,
+                                  "previous_hash": template.previous_hash,
+                                  "transactions": len(template.transactions),
+                                  "started": started}
+        return status
@@ -1,54 +1,227 @@
-from hashlib import sha256
+import cProfile
 import json
+import math
+import os
 import time
-import random
+import threading
+from collections import namedtuple
 from json import JSONEncoder
 
-from flask import Flask, request
+from flask import Flask, Response, g, request
 import requests
 
+from block import (Block, MerkleBlock, block_from_dict, block_with_hash,
+                   prune_block_data)
+from address_index import AddressIndex
+from block_store import BlockStore
+from block_tree import BlockTree
+from merkle import transaction_hash
+from json_stream import NDJSON_MIMETYPE, iter_chunks, iter_json_array, iter_ndjson
+from mempool import Mempool
+from metrics import MetricsRegistry
+from miner import BackgroundMiner
+from mining import ProofOfWorkEngine, difficulty_to_target
+from poet import make_certificate
+from profiling import SamplingProfiler
+from relay import TransactionRelay, compact_block, fill_compact_block
+from signatures import SignatureVerifier, generate_key, public_address
+from sync import ChainSync
+from transport import PeerTransport
+from wire import compress_chunks, content_encodings
+
 
 # the address to other participating members of the network
 peers = set()
+# guards `peers`, which is read and updated by the request threads.
+peers_lock = threading.Lock()
 
 
-class Block:
+def peer_list():
     """
-        Constructor for the `Block` class.
-        :param index: Unique ID of the block.
-        :param transactions: List of transactions.
-        :param timestamp: Time of generation of the block.
-        :param previos_hash: hash of the previos block.
-        :nonce: Nonce of the block.
-        """
-
-    def __init__(self, index, transactions, timestamp, previous_hash, nonce=0):
-        self.index = index
-        self.transactions = transactions
-        self.timestamp = timestamp
-        self.previous_hash = previous_hash
-        self.nonce = nonce
-
-    def compute_hash(self):
-        """
-        Creates a SHA-256 hash of a Block
-        :param block: Block.
-        """
-        block_string = json.dumps(self.__dict__, sort_keys=True)
-        return sha256(block_string.encode()).hexdigest()
+    Returns a copy of the peers, safe to iterate while they change.
+    """
+    with peers_lock:
+        return list(peers)
+
+
+# the length, last block and total work of the chain at some point in
+# time. The generation changes when blocks are replaced, so blocks read
+# below `length` belong to the snapshot as long as the generation is
+# the same.
+ChainSnapshot = namedtuple("ChainSnapshot", "length last_block generation work")
+
+# metrics of the node's hot paths, served by /metrics.
+metrics = MetricsRegistry()
+pow_hashes = metrics.counter("node_pow_hashes_total",
+                             "Hashes computed by the proof of work.")
+pow_seconds = metrics.histogram("node_pow_seconds",
+                                "Duration of the proof of work of a block.",
+                                ["result"], (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+pow_hashrate = metrics.gauge("node_pow_hashrate",
+                             "Hashes per second of the last proof of work.")
+consensus_seconds = metrics.histogram("node_consensus_seconds",
+                                      "Duration of a sync with the peers.",
+                                      ["replaced"])
+announce_seconds = metrics.histogram("node_block_announce_seconds",
+                                     "Duration of sending a block to a peer.",
+                                     ["peer"])
+announce_results = metrics.counter("node_block_announce_total",
+                                   "Blocks sent to the peers, by answer.",
+                                   ["peer", "result"])
+blocks_received = metrics.counter("node_blocks_received_total",
+                                  "Blocks received from the peers, by result.",
+                                  ["result"])
+transactions_received = metrics.counter("node_transactions_received_total",
+                                        "Transactions submitted or relayed, by status.",
+                                        ["status"])
+http_seconds = metrics.histogram("node_http_request_seconds",
+                                 "Duration of the HTTP requests, by route.",
+                                 ["method", "route"])
+http_requests = metrics.counter("node_http_requests_total",
+                                "HTTP requests, by route and status.",
+                                ["method", "route", "status"])
 
 
 class Blockchain:
     # difficulty of our PoW algorithm.
     # should be choosed accordingly.
+    # It sets the target of the first blocks, every block then carries
+    # its own target, see `next_target`.
     difficulty = 2
 
-    def __init__(self):
+    # the target is adjusted every `retarget_interval` blocks so that a
+    # block is mined every `block_interval` seconds, by a factor of at
+    # most `max_retarget_factor`, and never above `max_target`.
+    block_interval = 10.0
+    retarget_interval = 10
+    max_retarget_factor = 4
+    max_target = difficulty_to_target(1)
+
+    # how blocks are produced: "pow" for proof of work, or "poet" for
+    # proof of elapsed time, where each node waits for a time drawn from
+    # the previous block and its identity, without hashing, and the
+    # block carries a certificate of that wait, signed with its key. The
+    # mean wait is `poet_mean_wait` seconds, and only the nodes whose
+    # address is in `poet_miners` may publish blocks.
+    # With both, a block may be timestamped at most `max_clock_drift`
+    # seconds in the future, and must be timestamped after the median of
+    # the last `median_time_blocks` blocks, so the timestamps used to
+    # retarget can not be made up.
+    consensus = "pow"
+    poet_mean_wait = 10.0
+    poet_miners = frozenset()
+    max_clock_drift = 5.0
+    median_time_blocks = 11
+
+    # engine used by `proof_of_work`, can be replaced by any object
+    # with a `solve(block, difficulty, cancel=None, target=None)` method.
+    engine = ProofOfWorkEngine()
+
+    # mine blocks committing transactions through a Merkle root.
+    merkle_blocks = False
+
+    # transactions with a `signature` field must be signed by the key
+    # of their `fromAddress`, see signatures.py. Unsigned transactions
+    # are only accepted if signatures are not required.
+    require_signatures = False
+
+    # limits of the transactions put in a mined block, the rest of the
+    # pending transactions wait for the next block.
+    max_block_transactions = 500
+    max_block_bytes = 1024 * 1024
+
+    # side branches forking more than this many blocks below our tip
+    # are forgotten.
+    max_fork_depth = 100
+
+    # number of blocks below our tip which keep their transactions, the
+    # older blocks are pruned to their header, see `prune`. None keeps
+    # every block whole, an archival node. At least `max_fork_depth`
+    # blocks are kept, so a reorganisation by a received block never
+    # reaches a pruned block, and a synchronised chain forking at or
+    # below the pruned height is rejected, see `replace_suffix`.
+    # Blocks are pruned `prune_interval` at a time, as every prune
+    # writes to the block store and its index.
+    prune_window = None
+    prune_interval = 100
+
+    def __init__(self, checkpoint=None, store=None, address_index=None,
+                 node_key=None):
         """
         Constructor for the `Blockchain` class.
+        :param checkpoint: (index, hash) of a block known to be valid.
+        :param store: `BlockStore` keeping the chain on disk, by default
+                      the chain is only kept in memory.
+        :param address_index: `AddressIndex` updated with every block
+                              added to the chain.
+        :param node_key: Hex encoded private key signing the wait
+                         certificates of the blocks the node publishes,
+                         random by default. Its address is the node's
+                         identity, `node_id`.
+        """
+        self.node_key = node_key or generate_key()[0]
+        self.node_id = public_address(self.node_key)
+        self.mempool = Mempool()
+        # verifies the signatures of transactions, and caches the ones
+        # already verified.
+        self.verifier = SignatureVerifier()
+        self.chain = store if store is not None else []
+        self.checkpoint = checkpoint
+        self.address_index = address_index
+        # heights of the confirmed transactions, kept here when there is
+        # no address index to find them in, see `confirmed_height`.
+        self._tx_heights = {} if address_index is None else None
+        for block in self.chain if address_index is None else []:
+            self._index_transactions(block)
+        # blocks received which are not on our chain.
+        self.tree = BlockTree()
+        # held while the chain and its index change, never during proof
+        # of work or network requests.
+        self.lock = threading.RLock()
+        # called with the new snapshot every time the chain changes.
+        self.listeners = []
+        self._generation = 0
+        self._snapshot = None
+        # pruned height of an in-memory chain, see `pruned_height`.
+        self._pruned_height = 0
+        # work of the chain, updated as blocks are added and replaced.
+        self._work = self.chain_work(self.chain)
+        if self.chain:
+            self._publish()
+
+    def _publish(self):
+        self._snapshot = ChainSnapshot(len(self.chain), self.chain[-1],
+                                       self._generation, self._work)
+        for listener in self.listeners:
+            listener(self._snapshot)
+
+    @property
+    def snapshot(self):
+        """
+        The `ChainSnapshot` of the chain, which readers use instead of the
+        chain itself so that a page of blocks and the tip they return
+        are consistent.
+        """
+        return self._snapshot
+
+    def read_blocks(self, snapshot, start, end):
+        """
+        Returns the blocks of the snapshot with index in [start, end), or
+        None if blocks have been replaced since the snapshot was taken.
         """
-        self.unconfirmed_transactions = []
-        self.chain = []
+        with self.lock:
+            if snapshot.generation != self._generation:
+                return None
+            return list(self.chain[start:max(min(end, snapshot.length), start)])
+
+    def block_at(self, height):
+        """
+        Returns the block at `height`, or None if the chain is shorter.
+        """
+        with self.lock:
+            if 0 <= height < len(self.chain):
+                return self.chain[height]
+        return None
 
     def create_genesis_block(self):
         """
@@ -58,7 +231,17 @@ class Blockchain:
         """
         genesis_block = Block(0, [], 0, "0")
         genesis_block.hash = genesis_block.compute_hash()
-        self.chain.append(genesis_block)
+        with self.lock:
+            self.chain.append(genesis_block)
+            self._work += self.block_work(genesis_block)
+            self._publish()
+
+    @property
+    def unconfirmed_transactions(self):
+        """
+        The pending transactions, in the order they would be mined.
+        """
+        return [transaction for _, transaction in self.mempool.ordered()]
 
     @property
     def last_block(self):
@@ -68,136 +251,650 @@ class Blockchain:
         """
         return self.chain[-1]
 
-    def add_block(self, block, proof):
+    def add_block(self, block, proof, verify=True, check_signatures=True):
         """
         A function that adds the block to the chain after verification.
         Verification includes:
-        * Checking if the proof is valid.
+        * Checking if the proof is valid, unless `verify` is False.
         * The previous_hash referred in the block and the hash of latest block
           in the chain match.
+        * The signatures of its transactions are valid, unless `verify`
+          or `check_signatures` is False.
+        * None of its transactions is already confirmed.
+        The proof is checked before taking the chain lock.
         """
-        previous_hash = self.last_block.hash
-
-        if previous_hash != block.previous_hash:
+        last_block = self.snapshot.last_block
+        if block.previous_hash != last_block.hash:
             return False
 
-        if not Blockchain.is_valid_proof(block, proof):
+        if verify and (not self.is_valid_successor(block, last_block) or
+                       not Blockchain.is_valid_proof(block, proof) or
+                       (check_signatures and not self.has_valid_signatures([block]))):
+            return False
+        if not self.has_unconfirmed_transactions([block]):
             return False
 
-        block.hash = proof
-        self.chain.append(block)
+        with self.lock:
+            if self.last_block.hash != block.previous_hash:
+                return False
+            block.hash = proof
+            self._append(block)
+        self.mempool.remove_included(block.transactions)
         return True
 
+    def _append(self, block):
+        self.chain.append(block)
+        if self.address_index is not None:
+            self.address_index.add_block(block)
+        self._index_transactions(block)
+        self._work += self.block_work(block)
+        self._publish()
+
+    def receive_block(self, block, proof):
+        """
+        Adds a block received from a peer, which may not extend our tip.
+        * A block extending our tip is added to the chain.
+        * A block extending another block we know is kept in the block
+          tree, and its branch replaces the end of our chain if it has
+          more work than the blocks it replaces.
+        * A block whose parent is unknown is kept as an orphan.
+        Orphans waiting for the block are then added the same way.
+        Returns "added", "reorganised", "side", "orphan", "known" or
+        "invalid".
+        """
+        if proof in self.tree or self.get_block_by_hash(proof) is not None:
+            return "known"
+        # an orphan is only checked against the target it claims, which
+        # must stand for a real amount of work under our consensus.
+        if Blockchain.consensus == "poet":
+            if block.target is not None:
+                return "invalid"
+        elif block.certificate is not None or \
+                (block.target is not None and block.target > Blockchain.max_target):
+            return "invalid"
+        if not Blockchain.is_valid_proof(block, proof) or \
+                not self.has_valid_signatures([block]):
+            return "invalid"
+        block.hash = proof
+
+        result = self._connect(block)
+        connected = [block] if result in ("added", "reorganised", "side") else []
+        while connected:
+            parent = connected.pop()
+            # orphans are added by other threads under the lock.
+            with self.lock:
+                children = self.tree.pop_children(parent.hash)
+            for child in children:
+                child_result = self._connect(child)
+                if child_result in ("added", "reorganised", "side"):
+                    connected.append(child)
+                    if result == "side" or child_result == "reorganised":
+                        result = child_result
+        return result
+
+    def _connect(self, block):
+        """
+        Puts a block with a valid proof on our chain, in the block tree or
+        in the orphans. See `receive_block`.
+        """
+        with self.lock:
+            last_block = self.last_block
+            if block.previous_hash == last_block.hash:
+                if block.index != last_block.index + 1 or \
+                        not self.is_valid_successor(block, last_block) or \
+                        not self.has_unconfirmed_transactions([block]):
+                    return "invalid"
+                self._append(block)
+                branch = None
+            else:
+                parent = self.get_block_by_hash(block.previous_hash) or \
+                    self.tree.get(block.previous_hash)
+                if parent is None:
+                    self.tree.add_orphan(block)
+                    return "orphan"
+                if block.index != parent.index + 1 or \
+                        block.index <= last_block.index - Blockchain.max_fork_depth:
+                    return "invalid"
+                branch = self.tree.branch(block, self.get_block_by_hash)
+                if branch is None or not self.is_valid_successor(
+                        block, parent, self._branch_reader(branch)) or \
+                        not self.has_unconfirmed_transactions(branch, branch[0].index):
+                    return "invalid"
+                self.tree.add(block)
+        if branch is None:
+            self.mempool.remove_included(block.transactions)
+            return "added"
+
+        if self.replace_suffix(branch[0].index, branch):
+            return "reorganised"
+        return "side"
+
+    def _branch_reader(self, blocks):
+        """
+        Returns a function giving the block at a height on the branch of
+        `blocks`, which follow our block at height blocks[0].index - 1.
+        """
+        start = blocks[0].index
+
+        def block_at(height):
+            if height >= start:
+                return blocks[height - start]
+            return self.block_at(height)
+
+        return block_at
+
+    @classmethod
+    def block_target(cls, block):
+        """
+        The integer the hash of the block must be lower than. Blocks
+        without a target use the default difficulty.
+        """
+        if block.target is not None:
+            return block.target
+        return difficulty_to_target(Blockchain.difficulty)
+
+    def next_target(self, parent, block_at=None):
+        """
+        Returns the target of the block following `parent`. It is the
+        target of the parent, except every `retarget_interval` blocks
+        where it is scaled by how long the last blocks took to mine
+        compared to `block_interval`.
+        :param block_at: Returns the block at a given height on the
+                         branch of `parent`, defaults to our chain.
+        """
+        block_at = block_at or self.block_at
+        target = Blockchain.block_target(parent)
+        height = parent.index + 1
+        interval = Blockchain.retarget_interval
+        # the genesis block has no meaningful timestamp.
+        if height % interval or height <= interval:
+            return target
+
+        timespan = parent.timestamp - block_at(height - interval).timestamp
+        expected = (interval - 1) * Blockchain.block_interval
+        factor = Blockchain.max_retarget_factor
+        timespan = min(max(timespan, expected / factor), expected * factor)
+        # in milliseconds, so the 256-bit target is scaled exactly.
+        target = target * round(timespan * 1000) // round(expected * 1000)
+        return min(target, Blockchain.max_target)
+
+    def median_time_past(self, parent, block_at=None):
+        """
+        Returns the median timestamp of `parent` and the blocks before
+        it, `median_time_blocks` blocks at most.
+        :param block_at: See `next_target`.
+        """
+        block_at = block_at or self.block_at
+        first = max(parent.index - Blockchain.median_time_blocks + 1, 0)
+        timestamps = sorted([block_at(height).timestamp
+                             for height in range(first, parent.index)] +
+                            [parent.timestamp])
+        return timestamps[len(timestamps) // 2]
+
+    def is_valid_successor(self, block, parent, block_at=None):
+        """
+        Check if the block may follow `parent` under our consensus: with
+        proof of work its target must be the one given by `next_target`,
+        with proof of elapsed time it must carry a certificate and not
+        be timestamped before the end of the wait. With both it must be
+        timestamped after `median_time_past`, and not in the future.
+        :param block_at: See `next_target`.
+        """
+        if not (isinstance(block.timestamp, (int, float)) and
+                self.median_time_past(parent, block_at) < block.timestamp <=
+                time.time() + Blockchain.max_clock_drift):
+            return False
+        if Blockchain.consensus == "poet":
+            return (block.target is None and
+                    isinstance(block.certificate, dict) and
+                    isinstance(block.certificate.get("wait"), (int, float)) and
+                    block.timestamp >= parent.timestamp + block.certificate["wait"])
+        return (block.certificate is None and
+                block.target == self.next_target(parent, block_at))
+
+    @classmethod
+    def block_work(cls, block):
+        """
+        Expected number of hashes needed to mine the block. Every block
+        published with proof of elapsed time counts the same.
+        """
+        if block.certificate is not None:
+            return 1
+        return 2 ** 256 // Blockchain.block_target(block)
+
+    @classmethod
+    def chain_work(cls, blocks):
+        return sum(cls.block_work(block) for block in blocks)
+
     @classmethod
     def is_valid_proof(cls, block, block_hash):
         """
-        Check if block_hash is valid hash of block and satisfies
-        the difficulty criteria.
+        Check if block_hash is valid hash of block and is lower than
+        the target of the block, or for a block published with proof of
+        elapsed time, that its certificate is valid.
         """
-        return (block_hash.startswith('0' * Blockchain.difficulty) and
-                block_hash == block.compute_hash())
+        if block.certificate is not None:
+            return block.has_valid_certificate(block_hash, Blockchain.poet_mean_wait,
+                                               Blockchain.poet_miners)
+        return block.has_valid_proof(block_hash, Blockchain.block_target(block))
 
     @staticmethod
-    def proof_of_work(block):
+    def proof_of_work(block, cancel=None):
         """
         Function that tries different values of nonce to get a hash
         that satisfies our difficulty criteria.
+        The search itself is done by `Blockchain.engine`, the achieved
+        hash rate is available from `Blockchain.engine.stats()`.
+        Returns None if the `cancel` event is set before a nonce is found.
+        A block with a wait certificate is not hashed repeatedly: the
+        wait ends at the block's timestamp, until which we sleep.
+        """
+        if block.certificate is not None:
+            delay = block.timestamp - time.time()
+            if delay > 0:
+                if cancel is None:
+                    time.sleep(delay)
+                elif cancel.wait(delay):
+                    return None
+            return block.compute_hash()
+        started = time.perf_counter()
+        block_hash = Blockchain.engine.solve(block, Blockchain.difficulty, cancel,
+                                             Blockchain.block_target(block))
+        pow_seconds.observe(time.perf_counter() - started,
+                            result="cancelled" if block_hash is None else "solved")
+        stats = Blockchain.engine.stats()
+        pow_hashes.inc(stats["hashes"])
+        pow_hashrate.set(stats["hashrate"])
+        return block_hash
+
+    def valid_signatures(self, transactions):
+        """
+        Returns for each transaction whether it is signed by the key of
+        its `fromAddress`, or unsigned while signatures are not required.
         """
-        block.nonce = 0
+        results = [not Blockchain.require_signatures] * len(transactions)
+        signed = [position for position, transaction in enumerate(transactions)
+                  if isinstance(transaction, dict) and "signature" in transaction]
+        verified = self.verifier.verify_many([transactions[position]
+                                              for position in signed])
+        for position, valid in zip(signed, verified):
+            results[position] = valid
+        return results
+
+    def has_valid_signatures(self, blocks):
+        """
+        Check the signatures of all the transactions of the blocks, see
+        `valid_signatures`.
+        """
+        return all(self.valid_signatures([transaction for block in blocks
+                                          for transaction in block.transactions]))
 
-        computed_hash = block.compute_hash()
-        while not computed_hash.startswith('0' * Blockchain.difficulty):
-            block.nonce += 1
-            computed_hash = block.compute_hash()
+    def _index_transactions(self, block):
+        if self._tx_heights is not None:
+            for transaction in block.transactions:
+                if isinstance(transaction, dict):
+                    self._tx_heights[transaction_hash(transaction)] = block.index
 
-        return computed_hash
+    def confirmed_height(self, tx_hash):
+        """
+        Returns the height of the block of our chain which contains the
+        transaction, or None if it is not confirmed.
+        """
+        if self._tx_heights is not None:
+            return self._tx_heights.get(tx_hash)
+        location = self.address_index.find_transaction(tx_hash)
+        return None if location is None else location[0]
+
+    def has_unconfirmed_transactions(self, blocks, start=None):
+        """
+        Check if no transaction of `blocks` is confirmed on their branch
+        already, which would replay it: neither in our chain below height
+        `start`, where the blocks fork from it, nor in an earlier block.
+        By default the blocks extend our tip.
+        """
+        seen = set()
+        for block in blocks:
+            for transaction in block.transactions:
+                if not isinstance(transaction, dict):
+                    continue
+                tx_hash = transaction_hash(transaction)
+                height = self.confirmed_height(tx_hash)
+                if tx_hash in seen or \
+                        (height is not None and (start is None or height < start)):
+                    return False
+                seen.add(tx_hash)
+        return True
+
+    def knows_transaction(self, tx_hash):
+        """
+        Check if a transaction is pending or in our chain.
+        """
+        return tx_hash in self.mempool or self.confirmed_height(tx_hash) is not None
 
     def add_new_transaction(self, transaction):
         """
         This function adds new transaction to unconfirmed transactions pool
         which will be verified than added to block when mined.
+        Returns False if the transaction is already pending or confirmed,
+        or the pool is full.
         """
-        self.unconfirmed_transactions.append(transaction)
+        if self.confirmed_height(transaction_hash(transaction)) is not None:
+            return False
+        return self.mempool.add(transaction) is not None
 
-    @classmethod
-    def check_chain_validity(cls, chain):
+    def add_new_transactions(self, transactions):
         """
-        A helper method to check if the entire blockchain is valid.            
+        Adds several transactions to the pool at once. Returns a list
+        with False for each transaction which was not added, see
+        `add_new_transaction`.
         """
-        result = True
-        previous_hash = "0"
+        fresh = [self.confirmed_height(transaction_hash(transaction)) is None
+                 for transaction in transactions]
+        added = iter(self.mempool.add_many([transaction for transaction, is_fresh
+                                            in zip(transactions, fresh) if is_fresh]))
+        return [is_fresh and next(added) is not None for is_fresh in fresh]
 
-        # Iterate through every block
-        for block in chain:
+    def common_prefix_length(self, chain):
+        """
+        Returns how many blocks at the start of `chain` are the same as
+        in our chain. A block hash commits to all the blocks before it,
+        so the prefix is found with a binary search on the hashes.
+        """
+        with self.lock:
+            low, high = 0, min(len(chain), len(self.chain))
+            while low < high:
+                middle = (low + high + 1) // 2
+                if chain[middle - 1].hash == self.chain[middle - 1].hash:
+                    low = middle
+                else:
+                    high = middle - 1
+            return low
+
+    def check_chain_validity(self, chain):
+        """
+        A helper method to check if a candidate blockchain is valid.
+        Our own chain is already verified, so only the blocks after the
+        common prefix are checked.
+        """
+        start = self.common_prefix_length(chain)
+        if start == 0:
+            # the genesis block is different.
+            return False
+        return self.check_suffix_validity(start, chain[start:])
+
+    def trusted_index(self, start, blocks):
+        """
+        Returns the height up to which `blocks`, following our block at
+        height start - 1, match our trusted checkpoint.
+        """
+        if self.checkpoint is None:
+            return 0
+
+        index, checkpoint_hash = self.checkpoint
+        position = index - start
+        if 0 <= position < len(blocks) and blocks[position].hash == checkpoint_hash:
+            return index
+        block = self.block_at(index)
+        if index < start and block is not None and block.hash == checkpoint_hash:
+            return index
+        return 0
+
+    def check_suffix_validity(self, start, blocks, check_proofs=True):
+        """
+        Check if `blocks` are valid blocks following our block at height
+        start - 1. The signatures of the blocks up to a trusted
+        checkpoint are not checked, their links, targets and proofs are.
+        The proofs are not checked if `check_proofs` is False because
+        they have already been verified.
+        """
+        trusted_index = self.trusted_index(start, blocks)
+
+        previous = self.block_at(start - 1)
+        if previous is None:
+            return False
+        if not blocks:
+            return True
+        block_at = self._branch_reader(blocks)
+        previous_hash = previous.hash
+        for height, block in enumerate(blocks, start):
             block_hash = block.hash
-            # remove the hash field to recompute the hash again
-            # using `compute_hash` method.
-            delattr(block, "hash")
+            if previous_hash != block.previous_hash or block.index != height:
+                return False
 
-            if not cls.is_valid_proof(block, block_hash) or \
-                    previous_hash != block.previous_hash:
-                result = False
-                break
+            if not self.is_valid_successor(block, block_at(height - 1), block_at):
+                return False
 
-            block.hash, previous_hash = block_hash, block_hash
+            if check_proofs:
+                # remove the hash field to recompute the hash again
+                # using `compute_hash` method.
+                delattr(block, "hash")
+                valid = Blockchain.is_valid_proof(block, block_hash)
+                block.hash = block_hash
+                if not valid:
+                    return False
 
-        return result
+            previous_hash = block_hash
 
-    def poet(self):
-        min_time = 150
-        minor = {}
-        for x in peers:
-            minor = x
-            break
-
-        for x in peers:
-            time_node = random.randrange(1, 10)
-            if time_node < min_time:
-                min_time = time_node
-                minor = x
-
-        url = minor + "/mine"
-        requests.get(url)
+        if not self.has_unconfirmed_transactions(blocks, start):
+            return False
+        # all the signatures are verified in one batch.
+        return self.has_valid_signatures(blocks[max(trusted_index - start + 1, 0):])
+
+    def replace_suffix(self, start, blocks):
+        """
+        Replaces our blocks from height `start` onwards by `blocks`, which
+        have been checked with `check_suffix_validity`.
+        Our chain may have changed since they were checked, they are
+        only taken if they still follow our block at height start - 1
+        and have more work than the blocks they replace. Only these
+        blocks are rolled back: they move to the block tree, and their
+        transactions which are not in `blocks` go back to the pool.
+        Pruned blocks are never replaced, their transactions are lost.
+        Returns True if the blocks were taken.
+        """
+        with self.lock:
+            if not blocks or start <= self.pruned_height or start > len(self.chain) or \
+                    blocks[0].previous_hash != self.chain[start - 1].hash:
+                return False
+            replaced = self.chain[start:]
+            added_work = self.chain_work(blocks)
+            replaced_work = self.chain_work(replaced)
+            if added_work <= replaced_work:
+                return False
+
+            del self.chain[start:]
+            self.chain.extend(blocks)
+            if self.address_index is not None:
+                self.address_index.truncate(start)
+                for block in blocks:
+                    self.address_index.add_block(block)
+            else:
+                for block in replaced:
+                    for transaction in block.transactions:
+                        if isinstance(transaction, dict):
+                            self._tx_heights.pop(transaction_hash(transaction), None)
+                for block in blocks:
+                    self._index_transactions(block)
+            self._work += added_work - replaced_work
+            self._generation += 1
+            self._publish()
+
+            self.tree.remove(blocks)
+            for block in replaced:
+                self.tree.add(block)
+            self.tree.prune(self.last_block.index - Blockchain.max_fork_depth)
+
+        for block in replaced:
+            for transaction in block.transactions:
+                if isinstance(transaction, dict):
+                    self.mempool.add(transaction)
+        for block in blocks:
+            self.mempool.remove_included(block.transactions)
         return True
 
-        # for node in peers:
-        #     url = "http://" + node + "/time"
-        #     try:
-        #         response = requests.get(url)
-        #         if response.status_code == 200:
-        #             time_received = json.loads(response.text)
-        #             self.time_difference = time_received['time'] - time.time()
-        #     except:
-        #         continue
+    def get_block_by_hash(self, block_hash):
+        """
+        Returns the block of our chain with the given hash, or None.
+        """
+        with self.lock:
+            if isinstance(self.chain, BlockStore):
+                return self.chain.get_by_hash(block_hash)
+            for block in reversed(self.chain):
+                if block.hash == block_hash:
+                    return block
+        return None
 
-        #     time.sleep(random.randrange(1, 10))
-        #     response = requests.get(node + '/time')
+    @property
+    def pruned_height(self):
+        """
+        The blocks below this height have been pruned to their header.
+        """
+        if isinstance(self.chain, BlockStore):
+            return self.chain.pruned_height
+        return self._pruned_height
 
-    def mine(self):
+    def prune(self):
         """
-        This function serves as an interface to add the pending
-        transactions to the blockchain by adding them to the block
-        and figuring out Proof Of Work.
+        Prunes the blocks more than `prune_window` blocks below our tip
+        to their header, keeping their hash, so the chain stays linked
+        and its work known. The balances live in the address index, which
+        is not pruned. Returns True if blocks were pruned.
         """
-        if not self.unconfirmed_transactions:
+        if Blockchain.prune_window is None:
             return False
+        window = max(Blockchain.prune_window, Blockchain.max_fork_depth)
+        with self.lock:
+            chain = self.chain
+            height = len(chain) - window
+            if height - self.pruned_height < Blockchain.prune_interval:
+                return False
+            if not isinstance(chain, BlockStore):
+                for position in range(self._pruned_height, height):
+                    chain[position] = block_with_hash(
+                        prune_block_data(chain[position].to_dict()))
+                self._pruned_height = height
+                return True
+        # the store reads and writes the blocks without our lock, a
+        # reorganisation does not reach them, see `replace_suffix`.
+        chain.prune(height, prune_block_data)
+        return True
 
-        last_block = self.last_block
+    def save_checkpoint(self, path):
+        """
+        Stores the index and hash of our verified tip, a node started
+        with this checkpoint will not verify these blocks again. The
+        blocks which left the pruning window are pruned at the same time.
+        """
+        with self.lock:
+            last_block = self.last_block
+            # written aside and renamed, so a reader never sees half a file.
+            with open(path + ".tmp", "w") as checkpoint_file:
+                json.dump({"index": last_block.index,
+                           "hash": last_block.hash}, checkpoint_file)
+            os.replace(path + ".tmp", path)
+        self.prune()
 
-        # creating new block which will all unconfirmed transactions.
-        # will be added after the last block in the blockchain.
+    @staticmethod
+    def load_checkpoint(path):
+        """
+        Returns the (index, hash) stored by `save_checkpoint`, or None.
+        """
+        try:
+            with open(path) as checkpoint_file:
+                data = json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return None
+        return data["index"], data["hash"]
 
-        new_block = Block(index=last_block.index + 1,
-                          transactions=self.unconfirmed_transactions,
-                          timestamp=time.time(),
-                          previous_hash=last_block.hash)
+    @staticmethod
+    def load_node_key(path):
+        """
+        Returns the private key stored in the file, as written by
+        `signatures.py keygen`, creating a random one the first time, so
+        the node keeps its identity across restarts.
+        """
+        try:
+            with open(path) as node_key_file:
+                return json.load(node_key_file)["private_key"]
+        except OSError:
+            private_key, address = generate_key()
+            with open(path, "w") as node_key_file:
+                json.dump({"private_key": private_key, "address": address},
+                          node_key_file)
+            return private_key
 
-        proof = self.proof_of_work(new_block)
-        self.add_block(new_block, proof)
+    @staticmethod
+    def load_miners(path):
+        """
+        Returns the addresses listed in the file, one per line, or no
+        address if there is no file.
+        """
+        try:
+            with open(path) as miners_file:
+                return frozenset(line.strip() for line in miners_file if line.strip())
+        except OSError:
+            return frozenset()
 
-        self.unconfirmed_transactions = []
+    def new_block(self):
+        """
+        Returns a block to be mined on our tip with the highest priority
+        unconfirmed transactions, within the block size limits, or None
+        if there are no pending transactions.
+        """
+        if not self.mempool:
+            return None
+
+        last_block = self.snapshot.last_block
+        selected = self.mempool.select(Blockchain.max_block_transactions,
+                                       Blockchain.max_block_bytes)
+        # a transaction confirmed while it was added to the pool is
+        # dropped, the block would be refused.
+        for tx_hash, _ in selected:
+            if self.confirmed_height(tx_hash) is not None:
+                self.mempool.remove(tx_hash)
+        selected = [(tx_hash, tx) for tx_hash, tx in selected if tx_hash in self.mempool]
+        if not selected:
+            return None
+
+        block_class = MerkleBlock if Blockchain.merkle_blocks else Block
+        if Blockchain.consensus == "poet":
+            if self.node_id not in Blockchain.poet_miners:
+                return None
+            # the block is published when our wait is over.
+            certificate = make_certificate(last_block.hash, self.node_key,
+                                           Blockchain.poet_mean_wait)
+            return block_class(index=last_block.index + 1,
+                               transactions=[tx for _, tx in selected],
+                               timestamp=max(time.time(),
+                                             last_block.timestamp + certificate["wait"]),
+                               previous_hash=last_block.hash,
+                               certificate=certificate)
+        return block_class(index=last_block.index + 1,
+                           transactions=[tx for _, tx in selected],
+                           timestamp=time.time(),
+                           previous_hash=last_block.hash,
+                           target=self.next_target(last_block))
 
-        return True
+    def mine(self):
+        """
+        This function serves as an interface to add the pending
+        transactions to the blockchain by adding them to the block
+        and figuring out Proof Of Work.
+        The proof of work runs without holding the chain lock. If the
+        chain has changed in the meantime the block is discarded, and
+        its transactions stay in the pool.
+        Returns the mined block, or None.
+        """
+        new_block = self.new_block()
+        if new_block is None:
+            return None
+
+        proof = self.proof_of_work(new_block)
+        # the mined transactions are removed from the pool by add_block.
+        if not self.add_block(new_block, proof, verify=False):
+            return None
+
+        return new_block
 
 
 class BlockEncoder(JSONEncoder):
@@ -207,7 +904,7 @@ class BlockEncoder(JSONEncoder):
     """
 
     def default(self, o):
-        return o.__dict__
+        return o.to_dict()
 
 
 class BlockChainEncoder(JSONEncoder):
@@ -217,76 +914,533 @@ class BlockChainEncoder(JSONEncoder):
     """
 
     def default(self, o):
-        return o.__dict__
+        return o.to_dict()
 
 
 def print_chain(chain):
     node = chain
     print("[")
     for x in node:
-        print(json.dumps(x.__dict__, indent=4, cls=BlockChainEncoder))
+        print(json.dumps(x.to_dict(), indent=4, cls=BlockChainEncoder))
     print("]")
 
 
 app = Flask(__name__)
 
+# file storing the index and hash of the last verified block, a restarted
+# node does not verify the blocks up to it again.
+CHECKPOINT_FILE = "checkpoint.json"
+
+# maximum number of blocks returned by /blocks and headers by /headers.
+BLOCKS_PAGE_SIZE = 100
+HEADERS_PAGE_SIZE = 2000
+
+# directory of the on-disk block store. The stored blocks have already
+# been verified, so a restarted node continues from its last block.
+BLOCKS_DIR = "blocks"
+
+# database of the address and transaction index.
+INDEX_FILE = "index.db"
+
+# longest time a request to /tip waits for a new tip, in seconds.
+TIP_MAX_WAIT = 30.0
+
+# maximum number of transactions in a /transactions/batch request.
+BATCH_MAX_TRANSACTIONS = 10000
+
+# mine whenever there are pending transactions, instead of waiting
+# for a request to /mine.
+MINE_CONTINUOUSLY = False
+
+# key signing the wait certificates of the node's blocks, its address
+# is the identity of the node.
+NODE_KEY_FILE = "node_key"
+
+# addresses of the nodes allowed to publish blocks with proof of elapsed
+# time, one per line, the same on every node.
+POET_MINERS_FILE = "poet_miners"
+
+# allows profiling the node through /profile and the `profile` parameter
+# of any request, see `start_request`.
+PROFILING_ENABLED = False
+
+# directory the profiles of single requests are written to.
+PROFILES_DIR = "profiles"
+
+# longest time window of the sampling profiler, in seconds.
+PROFILE_MAX_SECONDS = 300
+
 # the node's copy of blockchain
-blockchain = Blockchain()
-blockchain.create_genesis_block()
+blockchain = Blockchain(Blockchain.load_checkpoint(CHECKPOINT_FILE),
+                        BlockStore(BLOCKS_DIR, decode=block_with_hash),
+                        AddressIndex(INDEX_FILE),
+                        Blockchain.load_node_key(NODE_KEY_FILE))
+Blockchain.poet_miners = Blockchain.load_miners(POET_MINERS_FILE)
+if not blockchain.chain:
+    blockchain.create_genesis_block()
+# only the blocks added since the index was last updated are indexed.
+blockchain.address_index.catch_up(blockchain.chain)
+
+# notified every time our chain changes, for the requests to /tip
+# waiting for a new tip.
+tip_changed = threading.Condition()
+
+
+def notify_tip_changed(snapshot):
+    with tip_changed:
+        tip_changed.notify_all()
+
+
+blockchain.listeners.append(notify_tip_changed)
+
+# pooled connections to the peers, with per-request timeouts.
+transport = PeerTransport()
+
+# downloads and verifies the blocks of heavier chains of the peers.
+chain_sync = ChainSync(blockchain, transport)
+
+# announces the transactions added to our pool to the peers.
+relay = TransactionRelay(transport, blockchain.mempool, peer_list)
+
+# samples the stacks of the node's threads, see /profile.
+profiler = SamplingProfiler()
+
+metrics.gauge("node_chain_length", "Number of blocks in our chain.",
+              function=lambda: blockchain.snapshot.length)
+metrics.gauge("node_pruned_height", "Height below which blocks are pruned.",
+              function=lambda: blockchain.pruned_height)
+metrics.gauge("node_mempool_transactions", "Number of pending transactions.",
+              function=lambda: len(blockchain.mempool))
+metrics.gauge("node_mempool_bytes", "Size of the pending transactions.",
+              function=lambda: blockchain.mempool.size_bytes)
+metrics.gauge("node_side_blocks", "Blocks kept on side branches.",
+              function=lambda: len(blockchain.tree))
+metrics.gauge("node_orphan_blocks", "Blocks waiting for their parent.",
+              function=lambda: blockchain.tree.orphan_count)
+metrics.gauge("node_peers", "Number of peers.",
+              function=lambda: len(peer_list()))
+
+
+@app.before_request
+def start_request():
+    """
+    Times every request. With profiling enabled, a request with a
+    `profile` parameter is profiled, and its statistics are written to
+    PROFILES_DIR as a pstats file named in the X-Profile header.
+    """
+    g.started = time.perf_counter()
+    if PROFILING_ENABLED and request.args.get("profile"):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+
+@app.after_request
+def finish_request(response):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.disable()
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        path = os.path.join(PROFILES_DIR, "{}-{}.pstats".format(
+            int(time.time() * 1000), request.endpoint))
+        profile.dump_stats(path)
+        response.headers["X-Profile"] = path
+
+    route = request.url_rule.rule if request.url_rule is not None else "unknown"
+    http_seconds.observe(time.perf_counter() - g.started,
+                         method=request.method, route=route)
+    http_requests.inc(method=request.method, route=route,
+                      status=response.status_code)
+    return response
+
+
+# endpoint to return the metrics of the node in the Prometheus text format.
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# endpoint to return the state of the sampling profiler.
+@app.route('/profile', methods=['GET'])
+def get_profile():
+    if not PROFILING_ENABLED:
+        return "Profiling is disabled", 403
+    return json.dumps(profiler.status())
+
+
+# endpoint to sample the stacks of the node for `seconds` seconds, every
+# `interval` seconds.
+@app.route('/profile/start', methods=['POST'])
+def start_profile():
+    if not PROFILING_ENABLED:
+        return "Profiling is disabled", 403
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = min(float(data.get("seconds", 10)), PROFILE_MAX_SECONDS)
+        interval = max(float(data.get("interval", 0.005)), 0.001)
+    except (TypeError, ValueError):
+        return "Invalid data", 400
+    if not profiler.start(seconds, interval):
+        return "The profiler is already running", 409
+    return json.dumps(profiler.status()), 202
 
 
-# endpoint to submit a new transaction. This will be used by
-# our application to add new data (posts) to the blockchain
-@app.route('/new_transaction', methods=['POST'])
-def new_transaction():
-    tx_data = request.get_json()
+@app.route('/profile/stop', methods=['POST'])
+def stop_profile():
+    if not PROFILING_ENABLED:
+        return "Profiling is disabled", 403
+    profiler.stop()
+    return json.dumps(profiler.status())
+
+
+# endpoint to return the samples of the profiler as folded stacks, which
+# flamegraph.pl or speedscope turn into a flame graph.
+@app.route('/profile/stacks', methods=['GET'])
+def get_profile_stacks():
+    if not PROFILING_ENABLED:
+        return "Profiling is disabled", 403
+    return Response(profiler.folded(), mimetype="text/plain")
+
+
+def parse_transaction(tx_data):
+    """
+    Checks a submitted transaction and adds the fields parsed from its
+    "from,to,amount" content, and its timestamp if it has none. The
+    amount must be a finite, non-negative number.
+    A transaction keeps the timestamp it is given, so its hash stays the
+    same when it is relayed, signed, or submitted again by a client
+    retrying, which is then a duplicate.
+    Returns the transaction, or None if it is invalid.
+    """
+    if not isinstance(tx_data, dict):
+        return None
     required_fields = ["author", "content"]
 
     for field in required_fields:
         if not tx_data.get(field):
-            return "Invalid transaction data", 404
+            return None
+    if not isinstance(tx_data["content"], str):
+        return None
 
-    tx_data["timestamp"] = time.time()
+    if not isinstance(tx_data.get("timestamp"), (int, float)):
+        tx_data["timestamp"] = time.time()
 
     tx_data_mixed = tx_data["content"].split(",")
+    if len(tx_data_mixed) != 3:
+        return None
+    try:
+        amount = float(tx_data_mixed[2])
+    except ValueError:
+        return None
+    # float() also parses "nan", "inf" and amounts too large for a float.
+    if not math.isfinite(amount) or amount < 0:
+        return None
     tx_data["fromAddress"] = tx_data_mixed[0]
     tx_data["toAddress"] = tx_data_mixed[1]
-    tx_data["amount"] = tx_data_mixed[2]
+    # amounts are stored as numbers, whole amounts as integers.
+    tx_data["amount"] = int(amount) if amount.is_integer() else amount
+    return tx_data
 
-    blockchain.add_new_transaction(tx_data)
 
-    return "Success", 201
+# endpoint to submit a new transaction. This will be used by
+# our application to add new data (posts) to the blockchain
+@app.route('/new_transaction', methods=['POST'])
+def new_transaction():
+    tx_data = parse_transaction(request.get_json())
+    if tx_data is None:
+        transactions_received.inc(status="invalid")
+        return "Invalid transaction data", 404
+
+    results = [None]
+    if add_transactions(results, [tx_data]):
+        return "Success", 201
+    if results[0]["status"] == "invalid":
+        return "Invalid transaction signature", 404
+    return "Duplicate transaction or pool full", 409
+
+
+def add_transactions(results, transactions):
+    """
+    Checks the signatures of parsed transactions and adds the valid ones
+    to the pool together, then announces them to the peers.
+    `results` holds None for each of the transactions, replaced by its
+    result. Returns the number of transactions added.
+    """
+    # the signatures of the batch are verified together.
+    signed = blockchain.valid_signatures(transactions)
+    parsed = [position for position, result in enumerate(results) if result is None]
+    valid = []
+    for position, transaction, is_signed in zip(parsed, transactions, signed):
+        if is_signed:
+            valid.append((position, transaction))
+        else:
+            results[position] = {"status": "invalid"}
+
+    added = blockchain.add_new_transactions([transaction for _, transaction in valid])
+    announced = []
+    for (position, transaction), is_added in zip(valid, added):
+        if is_added:
+            results[position] = {"status": "accepted"}
+            announced.append(transaction_hash(transaction))
+        else:
+            results[position] = {"status": "rejected",
+                                 "reason": "Duplicate transaction or pool full"}
+    for result in results:
+        transactions_received.inc(status=result["status"])
+    relay.announce(announced)
+    return len(announced)
+
+
+# endpoint to submit many transactions in one request, either as a JSON
+# array or as newline-delimited JSON (Content-Type application/x-ndjson).
+# The body is parsed as it is read, and the valid transactions are added
+# to the pool together. Returns the result of every transaction.
+@app.route('/transactions/batch', methods=['POST'])
+def new_transactions_batch():
+    chunks = iter_chunks(request.stream)
+    if request.mimetype == NDJSON_MIMETYPE:
+        items = iter_ndjson(chunks)
+    else:
+        items = iter_json_array(chunks)
+
+    results = []
+    transactions = []
+    try:
+        for position, tx_data in enumerate(items):
+            if position >= BATCH_MAX_TRANSACTIONS:
+                return "Batch larger than {} transactions".format(BATCH_MAX_TRANSACTIONS), 413
+            tx_data = parse_transaction(tx_data)
+            if tx_data is None:
+                results.append({"status": "invalid"})
+            else:
+                results.append(None)
+                transactions.append(tx_data)
+    except ValueError as error:
+        return "Invalid JSON after {} transactions: {}".format(len(results), error), 400
+
+    accepted = add_transactions(results, transactions)
+    return json.dumps({"accepted": accepted,
+                       "rejected": len(results) - accepted,
+                       "results": results})
+
+
+# endpoint to which peers announce the hashes of their new transactions,
+# answers with the hashes of the ones we do not know, see `TransactionRelay`.
+@app.route('/inventory', methods=['POST'])
+def receive_inventory():
+    inventory = (request.get_json() or {}).get("inventory")
+    if not isinstance(inventory, list):
+        return "Invalid data", 400
+    wanted = [tx_hash for tx_hash in inventory[:relay.max_inventory]
+              if isinstance(tx_hash, str) and not blockchain.knows_transaction(tx_hash)]
+    return json.dumps({"wanted": wanted})
+
+
+# endpoint to which peers send the transactions we asked for.
+@app.route('/transactions/relay', methods=['POST'])
+def receive_relayed_transactions():
+    tx_list = request.get_json()
+    if not isinstance(tx_list, list):
+        return "Invalid data", 400
+    transactions = [parse_transaction(tx_data)
+                    for tx_data in tx_list[:BATCH_MAX_TRANSACTIONS]]
+    results = [None if tx_data is not None else {"status": "invalid"}
+               for tx_data in transactions]
+    accepted = add_transactions(results, [tx_data for tx_data in transactions
+                                          if tx_data is not None])
+    return json.dumps({"accepted": accepted,
+                       "rejected": len(results) - accepted,
+                       "results": results})
+
+
+def wants_ndjson():
+    """
+    Check if the client asked for newline-delimited JSON rather than
+    a JSON document.
+    """
+    accepted = request.accept_mimetypes
+    return (NDJSON_MIMETYPE in accepted and
+            accepted.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE)
+
+
+def stream_response(chunks, mimetype):
+    """
+    Returns a response streaming the byte chunks, compressed with the
+    best content encoding the client accepts, if any.
+    """
+    headers = {"Vary": "Accept-Encoding"}
+    encoding = request.accept_encodings.best_match(content_encodings())
+    if encoding is not None:
+        chunks = compress_chunks(chunks, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+
+def iter_chain_pages():
+    """
+    Yields the blocks of the chain, BLOCKS_PAGE_SIZE at a time, so the
+    lock is never held for long. If the chain is reorganised in between,
+    the blocks are read on from the new chain as long as it still holds
+    the blocks already yielded, otherwise the chain ends there.
+    """
+    snapshot = blockchain.snapshot
+    start = 0
+    last_hash = None
+    while start < snapshot.length:
+        blocks = blockchain.read_blocks(snapshot, start, start + BLOCKS_PAGE_SIZE)
+        if blocks is None:
+            snapshot = blockchain.snapshot
+            last_block = blockchain.block_at(start - 1) if start else None
+            if last_block is not None and last_block.hash != last_hash:
+                return
+            continue
+        yield blocks
+        start += len(blocks)
+        last_hash = blocks[-1].hash
+
+
+def encode_blocks(blocks, ndjson):
+    """
+    Returns the JSON of the blocks as bytes, one per line for NDJSON or
+    separated by commas otherwise.
+    """
+    separator = "\n" if ndjson else ", "
+    text = separator.join(json.dumps(block.to_dict()) for block in blocks)
+    return (text + "\n" if ndjson else text).encode()
 
 
 # endpoint to return the node's copy of the chain.
 # Our application will be using this endpoint to query
 # all the posts to display.
+# The chain is streamed as it is read, as a JSON document, or with one
+# block per line if newline-delimited JSON is accepted, and compressed
+# if the client accepts gzip or zstd.
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    chain_data = []
-    for block in blockchain.chain:
-        chain_data.append(block.__dict__)
-    return json.dumps({"length": len(chain_data),
-                       "chain": chain_data,
-                       "peers": list(peers)})
+    if wants_ndjson():
+        chunks = (encode_blocks(blocks, True) for blocks in iter_chain_pages())
+        return stream_response(chunks, NDJSON_MIMETYPE)
+
+    def generate():
+        # the length is only known once the whole chain is sent.
+        yield b'{"chain": ['
+        length = 0
+        for blocks in iter_chain_pages():
+            yield (b", " if length else b"") + encode_blocks(blocks, False)
+            length += len(blocks)
+        yield '], "length": {}, "peers": {}}}'.format(
+            length, json.dumps(peer_list())).encode()
+
+    return stream_response(generate(), "application/json")
+
+
+def read_page(start, end):
+    """
+    Returns a snapshot of the chain and its blocks in [start, end).
+    """
+    while True:
+        snapshot = blockchain.snapshot
+        blocks = blockchain.read_blocks(snapshot, start, end)
+        if blocks is not None:
+            return snapshot, blocks
+
+
+def tip_data(snapshot=None):
+    """
+    Returns our tip, and whether we keep every block body or only the
+    bodies from `pruned_height` onwards, so peers know which blocks they
+    can download from us.
+    """
+    snapshot = snapshot or blockchain.snapshot
+    return {"length": snapshot.length,
+            "index": snapshot.last_block.index,
+            "hash": snapshot.last_block.hash,
+            "work": snapshot.work,
+            "archival": Blockchain.prune_window is None,
+            "pruned_height": blockchain.pruned_height}
+
+
+# endpoint to return the last block of the chain, so peers and the
+# application can cheaply find out if something changed.
+# Given the hash of the tip the client `known` and a `wait` time, it
+# waits up to that many seconds (at most TIP_MAX_WAIT) for another tip.
+@app.route('/tip', methods=['GET'])
+def get_tip():
+    known = request.args.get("known")
+    wait = min(request.args.get("wait", 0, type=float), TIP_MAX_WAIT)
+    if known and wait > 0:
+        with tip_changed:
+            tip_changed.wait_for(lambda: blockchain.snapshot.last_block.hash != known,
+                                 timeout=wait)
+    return json.dumps(tip_data())
+
+
+# endpoint to return the blocks with index in [from, to), at most
+# BLOCKS_PAGE_SIZE of them. With newline-delimited JSON only the
+# blocks are returned, one per line.
+# A pruned node answers 410 for blocks it only has the header of, their
+# headers are still served by /headers.
+@app.route('/blocks', methods=['GET'])
+def get_blocks():
+    start = max(request.args.get("from", 0, type=int), 0)
+    end = min(max(request.args.get("to", start + BLOCKS_PAGE_SIZE, type=int), start),
+              start + BLOCKS_PAGE_SIZE)
+    if start < blockchain.pruned_height:
+        return "Blocks below {} are pruned".format(blockchain.pruned_height), 410
+    snapshot, blocks = read_page(start, end)
+    if wants_ndjson():
+        return stream_response([encode_blocks(blocks, True)], NDJSON_MIMETYPE)
+    body = json.dumps({"from": start,
+                       "to": start + len(blocks),
+                       "blocks": [block.to_dict() for block in blocks],
+                       "tip": tip_data(snapshot)})
+    return stream_response([body.encode()], "application/json")
+
+
+# endpoint to return a single block by its hash.
+@app.route('/block/<block_hash>', methods=['GET'])
+def get_block(block_hash):
+    try:
+        block = blockchain.get_block_by_hash(block_hash)
+    except ValueError:
+        block = None
+    if block is None:
+        return "Unknown block", 404
+    return json.dumps(block.to_dict())
+
+
+# endpoint to return the headers of the blocks from index `from`, at
+# most `count` and HEADERS_PAGE_SIZE of them.
+@app.route('/headers', methods=['GET'])
+def get_headers():
+    start = max(request.args.get("from", 0, type=int), 0)
+    count = max(request.args.get("count", HEADERS_PAGE_SIZE, type=int), 0)
+    snapshot, blocks = read_page(start, start + min(count, HEADERS_PAGE_SIZE))
+    headers = []
+    for block in blocks:
+        header = block.header()
+        header["hash"] = block.hash
+        headers.append(header)
+    return json.dumps({"from": start,
+                       "headers": headers,
+                       "tip": tip_data(snapshot)})
 
 
 # endpoint to request the node to mine the unconfirmed
 # transactions (if any). We'll be using it to initiate
 # a command to mine from our application itself.
+# The blocks are mined in the background, see /mine/status.
 @app.route('/mine', methods=['GET'])
 def mine_unconfirmed_transactions():
-    result = blockchain.mine()
-    if not result:
+    if not blockchain.mempool:
         return "No transactions to mine"
-    else:
-        # Making sure we have the longest chain before announcing to the network
-        chain_length = len(blockchain.chain)
-        consensus()
-        if chain_length == len(blockchain.chain):
-            # announce the recently mined block to the network
-            announce_new_block(blockchain.last_block)
-        return "Block #{} is mined.".format(blockchain.last_block.index)
+    miner.trigger()
+    return "Mining the pending transactions, see /mine/status", 202
+
+
+# endpoint to return what the background miner is doing.
+@app.route('/mine/status', methods=['GET'])
+def get_mine_status():
+    return json.dumps(miner.status())
 
 
 # endpoint to add new peers to the network.
@@ -297,11 +1451,13 @@ def register_new_peers():
         return "Invalid data", 400
 
     # Add the node to the peer list
-    peers.add(node_address)
+    with peers_lock:
+        peers.add(node_address)
 
-    # Return the consensus blockchain to the newly registered node
-    # so that he can sync
-    return get_chain()
+    # Return our tip and peers to the newly registered node, so that
+    # he can sync the blocks he is missing
+    return json.dumps({"tip": tip_data(),
+                       "peers": peer_list()})
 
 
 @app.route('/register_with', methods=['POST'])
@@ -320,60 +1476,227 @@ def register_with_existing_node():
 
     # Make a request to register with remote node and obtain information
     response = requests.post(node_address + "/register_node",
-                             data=json.dumps(data), headers=headers)
+                             data=json.dumps(data), headers=headers,
+                             timeout=transport.timeout)
 
     if response.status_code == 200:
-        global blockchain
-        global peers
-        # update chain and the peers
-        chain_dump = response.json()['chain']
-        blockchain = create_chain_from_dump(chain_dump)
-        peers.update(response.json()['peers'])
+        # update the peers and sync the chain from the node and its
+        # peers, the blocks we already have are not downloaded again.
+        with peers_lock:
+            peers.update(response.json()['peers'])
+            peers.add(node_address.rstrip("/") + "/")
+            peers.discard(request.host_url)
+        if chain_sync.sync(peer_list()):
+            blockchain.save_checkpoint(CHECKPOINT_FILE)
         return "Registration successful", 200
     else:
         # if something goes wrong, pass it on to the API response
         return response.content, response.status_code
 
 
-def create_chain_from_dump(chain_dump):
-    generated_blockchain = Blockchain()
+def create_chain_from_dump(chain_dump, checkpoint=None):
+    """
+    Rebuilds a blockchain from the JSON blocks of a peer, which can be
+    any iterable, e.g. the blocks of `PeerTransport.iter_json_lines`
+    parsed as they are downloaded. If the dump contains the checkpoint
+    block, the signatures of the blocks up to it are not verified, their
+    proofs and links are.
+    """
+    generated_blockchain = Blockchain(checkpoint)
     generated_blockchain.create_genesis_block()
+    trusted_index, checkpoint_hash = checkpoint or (0, None)
+    # blocks added before the checkpoint, whose signatures are verified
+    # if it does not match.
+    unverified = []
+
+    def verify(blocks):
+        if not generated_blockchain.has_valid_signatures(blocks):
+            raise Exception("The chain dump is tampered!!")
+        blocks.clear()
+
     for idx, block_data in enumerate(chain_dump):
         if idx == 0:
             continue  # skip genesis block
-        block = Block(block_data["index"],
-                      block_data["transactions"],
-                      block_data["timestamp"],
-                      block_data["previous_hash"],
-                      block_data["nonce"])
+        block = block_from_dict(block_data)
         proof = block_data['hash']
-        added = generated_blockchain.add_block(block, proof)
+        trusted = idx <= trusted_index
+        if idx == trusted_index and proof != checkpoint_hash:
+            trusted = False
+            verify(unverified)
+        added = generated_blockchain.add_block(block, proof,
+                                               check_signatures=not trusted)
         if not added:
             raise Exception("The chain dump is tampered!!")
+        if idx == trusted_index:
+            unverified.clear()
+        elif trusted:
+            unverified.append(block)
+
+    # the dump ended before the checkpoint.
+    verify(unverified)
     return generated_blockchain
 
 
 # endpoint to add a block mined by someone else to
 # the node's chain. The block is first verified by the node
-# and then added to the chain.
+# and then added to the chain, or kept aside if it is on another
+# branch or its parent is unknown, see `Blockchain.receive_block`.
 @app.route('/add_block', methods=['POST'])
 def verify_and_add_block():
     block_data = request.get_json()
-    block = Block(block_data["index"],
-                  block_data["transactions"],
-                  block_data["timestamp"],
-                  block_data["previous_hash"],
-                  block_data["nonce"])
+    block = block_from_dict(block_data)
 
     proof = block_data['hash']
-    added = blockchain.add_block(block, proof)
+    result = process_block(block, proof)
 
-    if not added:
+    if result == "invalid":
         return "The block was discarded by the node", 400
-
+    if result == "known":
+        return "Block already known", 200
+    if result == "orphan":
+        return "Block kept until its parent arrives", 202
+    if result == "side":
+        return "Block kept on a side branch", 202
     return "Block added to the chain", 201
 
 
+def process_block(block, proof):
+    """
+    Adds a block received from a peer, see `Blockchain.receive_block`,
+    and relays it if it extends our chain. Returns the result.
+    """
+    result = blockchain.receive_block(block, proof)
+    blocks_received.inc(result=result)
+    if result == "orphan":
+        # the blocks between our chain and the orphan are missing.
+        sync_in_background()
+    elif result in ("added", "reorganised"):
+        blockchain.save_checkpoint(CHECKPOINT_FILE)
+        # relay the block, peers which already have it will discard it.
+        announce_new_block(block)
+    return result
+
+
+# HTTP status of the answers to /compact_block, by result.
+COMPACT_BLOCK_STATUS = {"invalid": 400, "known": 200, "orphan": 202, "side": 202,
+                        "added": 201, "reorganised": 201, "missing": 200,
+                        "mismatch": 200}
+
+
+# endpoint to add a block announced in compact form, see `compact_block`.
+# Its transactions are taken from our pool, the ones we do not have are
+# answered as "missing" and sent again by the peer with the block under
+# "missing_transactions". If the block rebuilt from our pool does not
+# match its hash, the answer is "mismatch" and the peer sends the whole
+# block to /add_block.
+@app.route('/compact_block', methods=['POST'])
+def receive_compact_block():
+    compact = request.get_json()
+    try:
+        proof = compact["hash"]
+        if proof in blockchain.tree or blockchain.get_block_by_hash(proof) is not None:
+            result, missing = "known", []
+        else:
+            sent = compact.get("missing_transactions") or {}
+            block_data, missing = fill_compact_block(compact,
+                                                     blockchain.mempool.items(), sent)
+            if missing:
+                result = "missing"
+            else:
+                block = block_from_dict(block_data)
+                if len(sent) < len(block.transactions) and \
+                        not Blockchain.is_valid_proof(block, proof):
+                    # a short id matched another transaction of our pool.
+                    result = "mismatch"
+                else:
+                    result = process_block(block, proof)
+    except (KeyError, TypeError, AttributeError):
+        return "Invalid data", 400
+    return json.dumps({"result": result, "missing": missing}), \
+        COMPACT_BLOCK_STATUS[result]
+
+
+# endpoint to get the Merkle inclusion proof of a transaction, so a
+# client can verify it against the block header without the whole block.
+@app.route('/tx_proof/<int:block_index>/<int:position>', methods=['GET'])
+def get_tx_proof(block_index, position):
+    block = blockchain.block_at(block_index)
+    if block is None:
+        return "Unknown block", 404
+
+    if not isinstance(block, MerkleBlock):
+        return "Block has no Merkle root", 400
+    if block.pruned:
+        return "Block is pruned", 410
+    if not 0 <= position < len(block.transactions):
+        return "Unknown transaction", 404
+
+    return json.dumps({"header": block.header(),
+                       "hash": block.hash,
+                       "transaction": block.transactions[position],
+                       "proof": block.merkle_proof(position)})
+
+
+# endpoint to return the balance and the transactions of an address,
+# newest first. The next page starts after the given height and position.
+@app.route('/address/<address>', methods=['GET'])
+def get_address(address):
+    limit = min(request.args.get("limit", 50, type=int), 500)
+    before = None
+    if "before_height" in request.args:
+        before = (request.args.get("before_height", type=int),
+                  request.args.get("before_position", 0, type=int))
+
+    transactions = []
+    for height, position, tx_hash in blockchain.address_index.history(address, limit, before):
+        block = blockchain.block_at(height)
+        if block is not None and block.pruned:
+            # only the hash of the transaction is left.
+            transactions.append({"height": height,
+                                 "position": position,
+                                 "hash": tx_hash,
+                                 "pruned": True})
+            continue
+        if block is None or position >= len(block.transactions):
+            # the block has been reorganised away since the query.
+            continue
+        transactions.append({"height": height,
+                             "position": position,
+                             "hash": tx_hash,
+                             "transaction": block.transactions[position]})
+    return json.dumps({"address": address,
+                       "balance": blockchain.address_index.balance(address),
+                       "transactions": transactions})
+
+
+# endpoint to return a transaction by its hash, either confirmed or pending.
+@app.route('/tx/<tx_hash>', methods=['GET'])
+def get_transaction(tx_hash):
+    location = blockchain.address_index.find_transaction(tx_hash)
+    block = blockchain.block_at(location[0]) if location is not None else None
+    if block is not None and block.pruned:
+        height, position = location
+        return json.dumps({"hash": tx_hash,
+                           "status": "confirmed",
+                           "height": height,
+                           "position": position,
+                           "pruned": True})
+    if block is not None and location[1] < len(block.transactions):
+        height, position = location
+        return json.dumps({"hash": tx_hash,
+                           "status": "confirmed",
+                           "height": height,
+                           "position": position,
+                           "transaction": block.transactions[position]})
+
+    transaction = blockchain.mempool.get(tx_hash)
+    if transaction is not None:
+        return json.dumps({"hash": tx_hash,
+                           "status": "pending",
+                           "transaction": transaction})
+    return "Unknown transaction", 404
+
+
 # endpoint to query unconfirmed transactions
 @app.route('/pending_tx')
 def get_pending_tx():
@@ -382,27 +1705,36 @@ def get_pending_tx():
 
 def consensus():
     """
-    Our naive consnsus algorithm. If a longer valid chain is
+    Our naive consnsus algorithm. If a valid chain with more work is
     found, our chain is replaced with it.
+    The chain is synced headers first, see `ChainSync`.
     """
-    global blockchain
+    started = time.perf_counter()
+    replaced = chain_sync.sync(peer_list())
+    consensus_seconds.observe(time.perf_counter() - started,
+                              replaced=str(replaced).lower())
+    return replaced
 
-    longest_chain = None
-    current_len = len(blockchain.chain)
 
-    for node in peers:
-        response = requests.get('{}chain'.format(node))
-        length = response.json()['length']
-        chain = response.json()['chain']
-        if length > current_len and blockchain.check_chain_validity(chain):
-            current_len = length
-            longest_chain = chain
+# held while a sync started by `sync_in_background` runs.
+background_sync = threading.Lock()
 
-    if longest_chain:
-        blockchain = longest_chain
-        return True
 
-    return False
+def sync_in_background():
+    """
+    Starts `consensus` in a background thread, unless one is running.
+    """
+    if not background_sync.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            if consensus():
+                blockchain.save_checkpoint(CHECKPOINT_FILE)
+        finally:
+            background_sync.release()
+
+    threading.Thread(target=run, daemon=True).start()
 
 
 def announce_new_block(block):
@@ -410,10 +1742,52 @@ def announce_new_block(block):
     A function to announce to the network once a block has been mined.
     Other blocks can simply verify the proof of work and add it to their
     respective chains.
+    The block is gossiped in the background to at most `transport.fanout`
+    peers, which relay it to theirs when they accept it. It is sent in
+    compact form, see `send_compact_block`.
+    """
+    transport.gossip(peer_list(), send_compact_block, block, compact_block(block))
+
+
+def send_compact_block(peer, block, compact):
+    """
+    Sends a block to a peer in compact form, then the transactions the
+    peer does not have, or the whole block if the peer could not rebuild
+    it from its pool.
+    """
+    started = time.perf_counter()
+    try:
+        response = transport.post_json(peer, "compact_block", compact)
+        result = response.json()["result"]
+        if result == "missing":
+            missing = {str(position): block.transactions[position]
+                       for position in response.json()["missing"]
+                       if 0 <= position < len(block.transactions)}
+            response = transport.post_json(peer, "compact_block",
+                                           dict(compact, missing_transactions=missing))
+            result = response.json()["result"]
+        if result in ("missing", "mismatch"):
+            response = transport.post_json(peer, "add_block", block.to_dict())
+            result = "full block {}".format(response.status_code)
+    except (requests.RequestException, ValueError, KeyError, TypeError):
+        result = "error"
+    announce_seconds.observe(time.perf_counter() - started, peer=peer)
+    announce_results.inc(peer=peer, result=result)
+
+
+def block_mined(block):
+    """
+    Called by the miner with every block it adds to our chain.
     """
-    for peer in peers:
-        url = "{}add_block".format(peer)
-        headers = {'Content-Type': "application/json"}
-        requests.post(url,
-                      data=json.dumps(block.__dict__, sort_keys=True),
-                      headers=headers)
+    # Making sure we have the longest chain before announcing to the network
+    consensus()
+    if blockchain.get_block_by_hash(block.hash) is not None:
+        # announce the recently mined block to the network
+        announce_new_block(block)
+    blockchain.save_checkpoint(CHECKPOINT_FILE)
+
+
+# mines on our tip in the background, started by the first /mine.
+miner = BackgroundMiner(blockchain, block_mined, continuous=MINE_CONTINUOUSLY)
+if MINE_CONTINUOUSLY:
+    miner.start()
@@ -0,0 +1,71 @@
+import math
+from hashlib import sha256
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import (Ed25519PrivateKey,
+                                                               Ed25519PublicKey)
+
+from signatures import public_address
+
+
+def draw_wait(previous_hash, miner, mean_wait):
+    """
+    Returns the time, in seconds, the miner has to wait after the block
+    `previous_hash` before it may publish the next block.
+    The wait is drawn from an exponential distribution with the given
+    mean, seeded by the previous block and the miner, so every node can
+    recompute it and no node can choose it.
+    :param previous_hash: Hash of the block the new block follows.
+    :param miner: Address of the node publishing the block.
+    :param mean_wait: Mean wait, in seconds.
+    """
+    seed = sha256("{}:{}".format(previous_hash, miner).encode()).digest()
+    draw = int.from_bytes(seed[:8], "big") / 2 ** 64
+    # rounded so the value survives the JSON round trip exactly.
+    return round(-mean_wait * math.log1p(-draw), 3)
+
+
+def certificate_payload(previous_hash, wait):
+    """
+    Returns the bytes a miner signs in its wait certificate.
+    """
+    return "{}:{!r}".format(previous_hash, wait).encode()
+
+
+def make_certificate(previous_hash, private_key, mean_wait):
+    """
+    Returns the wait certificate a miner puts in its block, signed by
+    its hex encoded private key. The miner is the address of the key.
+    """
+    miner = public_address(private_key)
+    wait = draw_wait(previous_hash, miner, mean_wait)
+    key = Ed25519PrivateKey.from_private_bytes(bytes.fromhex(private_key))
+    return {"miner": miner,
+            "wait": wait,
+            "signature": key.sign(certificate_payload(previous_hash, wait)).hex()}
+
+
+def is_valid_certificate(certificate, previous_hash, mean_wait, miners):
+    """
+    Check if the certificate carries the wait drawn for its miner after
+    the block `previous_hash`, and is signed by the miner, which must be
+    one of the registered `miners`. Otherwise a node could try many
+    identities until one draws a short wait.
+    That the block was not published before the wait was over is checked
+    against the time of the previous block.
+    :param miners: Addresses of the nodes allowed to publish blocks.
+    """
+    if not (isinstance(certificate, dict) and
+            isinstance(certificate.get("miner"), str) and
+            certificate["miner"] in miners and
+            certificate.get("wait") == draw_wait(previous_hash,
+                                                 certificate["miner"],
+                                                 mean_wait)):
+        return False
+    try:
+        key = Ed25519PublicKey.from_public_bytes(bytes.fromhex(certificate["miner"]))
+        key.verify(bytes.fromhex(certificate["signature"]),
+                   certificate_payload(previous_hash, certificate["wait"]))
+    except (InvalidSignature, AttributeError, KeyError, TypeError, ValueError):
+        return False
+    return True
@@ -0,0 +1,91 @@
+import collections
+import sys
+import threading
+import time
+
+
+def _folded_stack(frame):
+    """
+    Returns the stack of a frame as "outermost;...;innermost" function
+    names, the format of flamegraph.pl and speedscope.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({}:{})".format(code.co_name, code.co_filename,
+                                         code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all the threads of the process every
+    `interval` seconds from a background thread, for a time window.
+    The samples are counted by stack and dumped as folded stacks, one
+    "stack count" line per stack, ready for a flame graph.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self.samples = 0
+        self.started = None
+        self.interval = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration, interval=0.005):
+        """
+        Starts sampling for `duration` seconds, dropping the previous
+        samples. Returns False if a window is already running.
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self._stacks = collections.Counter()
+            self.samples = 0
+            self.started = time.time()
+            self.interval = interval
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            args=(duration, interval), daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self, duration, interval):
+        deadline = time.monotonic() + duration
+        own_id = threading.get_ident()
+        while time.monotonic() < deadline and not self._stop.wait(interval):
+            frames = sys._current_frames()
+            stacks = [_folded_stack(frame) for thread_id, frame in frames.items()
+                      if thread_id != own_id]
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += 1
+
+    def folded(self):
+        """
+        Returns the samples as folded stacks, most frequent first.
+        """
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return "".join("{} {}\n".format(stack, count) for stack, count in stacks)
+
+    def status(self):
+        return {"running": self.running,
+                "started": self.started,
+                "interval": self.interval,
+                "samples": self.samples,
+                "stacks": len(self._stacks)}
+
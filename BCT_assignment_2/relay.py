@@ -0,0 +1,126 @@
+import threading
+import time
+
+import requests
+
+from merkle import transaction_hash
+
+# number of hex digits of a transaction hash used as its short id in
+# compact blocks.
+SHORT_ID_LENGTH = 12
+
+
+def short_id(tx_hash):
+    return tx_hash[:SHORT_ID_LENGTH]
+
+
+def compact_block(block):
+    """
+    Returns the compact form of a block: its JSON representation with
+    its transactions replaced by their short ids.
+    """
+    block_data = block.to_dict()
+    block_data["short_ids"] = [short_id(transaction_hash(transaction))
+                               for transaction in block_data.pop("transactions")]
+    return block_data
+
+
+def fill_compact_block(compact, pool_items, sent=None):
+    """
+    Rebuilds the JSON representation of a compact block, taking its
+    transactions from `sent`, the transactions by position sent along
+    with it, or else from the pool.
+    Returns the block JSON and the positions of the transactions which
+    were found in neither, the JSON being None if there are some.
+    :param pool_items: The (hash, transaction) pairs of the pool.
+    """
+    sent = sent or {}
+    short_ids = compact["short_ids"]
+    wanted = set(short_ids)
+    by_short_id = {}
+    for tx_hash, transaction in pool_items:
+        if short_id(tx_hash) in wanted:
+            by_short_id[short_id(tx_hash)] = transaction
+
+    transactions = []
+    missing = []
+    for position, tx_short_id in enumerate(short_ids):
+        transaction = sent.get(str(position), by_short_id.get(tx_short_id))
+        if transaction is None:
+            missing.append(position)
+        transactions.append(transaction)
+    if missing:
+        return None, missing
+
+    block_data = {key: value for key, value in compact.items() if key != "short_ids"}
+    block_data["transactions"] = transactions
+    return block_data, []
+
+
+class TransactionRelay:
+    """
+    Announces the transactions added to our pool to the peers by hash.
+    The hashes are collected for `interval` seconds and sent together to
+    /inventory of at most `transport.fanout` peers, which answer with
+    the hashes they do not have yet, and only these transactions are
+    then sent to their /transactions/relay. A peer adding them announces
+    them in turn, so every pool ends up with every transaction.
+    :param transport: `PeerTransport` used to talk to the peers.
+    :param mempool: Our `Mempool`, where the announced transactions are.
+    :param peers: Returns the current list of peers.
+    :param interval: Time the hashes are collected for, in seconds.
+    :param max_inventory: Maximum number of hashes per announcement.
+    """
+
+    def __init__(self, transport, mempool, peers, interval=0.2, max_inventory=1000):
+        self.transport = transport
+        self.mempool = mempool
+        self.peers = peers
+        self.interval = interval
+        self.max_inventory = max_inventory
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def announce(self, tx_hashes):
+        """
+        Queues the hashes of transactions added to our pool.
+        """
+        if not tx_hashes:
+            return
+        with self._lock:
+            self._pending.extend(tx_hashes)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # the hashes arriving meanwhile are announced together.
+            time.sleep(self.interval)
+            self._wake.clear()
+            with self._lock:
+                inventory = self._pending[:self.max_inventory]
+                del self._pending[:self.max_inventory]
+                if self._pending:
+                    self._wake.set()
+            if inventory:
+                self.transport.gossip(self.peers(), self._send, inventory)
+
+    def _send(self, peer, inventory):
+        try:
+            response = self.transport.post_json(peer, "inventory",
+                                                {"inventory": inventory})
+            if response.status_code != 200:
+                return
+            transactions = [self.mempool.get(tx_hash)
+                            for tx_hash in response.json()["wanted"]]
+            transactions = [transaction for transaction in transactions
+                            if transaction is not None]
+            if transactions:
+                self.transport.post_json(peer, "transactions/relay", transactions)
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            pass
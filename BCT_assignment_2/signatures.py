@@ -0,0 +1,170 @@
+"""
+Ed25519 signatures of transactions.
+
+The address of an account is its hex encoded public key, and a signed
+transaction carries in its `signature` field the signature, by the key
+of its `fromAddress`, of the transaction without that field.
+Keys can be generated and transactions signed from the command line:
+
+    $ python signatures.py keygen
+    $ python signatures.py sign --key <private key> --to <address> --amount 5 --author me
+"""
+import argparse
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import (Ed25519PrivateKey,
+                                                               Ed25519PublicKey)
+from cryptography.hazmat.primitives.serialization import (Encoding, NoEncryption,
+                                                          PrivateFormat, PublicFormat)
+
+from merkle import transaction_hash
+
+
+def signing_payload(transaction):
+    """
+    Returns the bytes signed for a transaction: its JSON without the
+    signature, with sorted keys as for its hash.
+    """
+    unsigned = {key: value for key, value in transaction.items() if key != "signature"}
+    return json.dumps(unsigned, sort_keys=True).encode()
+
+
+def generate_key():
+    """
+    Returns a new (private key, address) pair, both hex encoded.
+    """
+    private_key = Ed25519PrivateKey.generate()
+    private_bytes = private_key.private_bytes(Encoding.Raw, PrivateFormat.Raw,
+                                              NoEncryption())
+    public_bytes = private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    return private_bytes.hex(), public_bytes.hex()
+
+
+def public_address(private_key):
+    """
+    Returns the address of a hex encoded private key.
+    """
+    key = Ed25519PrivateKey.from_private_bytes(bytes.fromhex(private_key))
+    return key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw).hex()
+
+
+def sign_transaction(transaction, private_key):
+    """
+    Adds the signature of the transaction by the hex encoded private key.
+    """
+    key = Ed25519PrivateKey.from_private_bytes(bytes.fromhex(private_key))
+    transaction["signature"] = key.sign(signing_payload(transaction)).hex()
+    return transaction
+
+
+def verify_signature(transaction):
+    """
+    Check if the transaction is signed by the key of its `fromAddress`.
+    The signature must be in lowercase hex: the hash of the transaction
+    covers it, and a node rejects a transaction whose hash is already
+    confirmed, which a signature written differently would get around.
+    """
+    try:
+        key = Ed25519PublicKey.from_public_bytes(bytes.fromhex(transaction["fromAddress"]))
+        signature = bytes.fromhex(transaction["signature"])
+        if signature.hex() != transaction["signature"]:
+            return False
+        key.verify(signature, signing_payload(transaction))
+    except (InvalidSignature, AttributeError, KeyError, TypeError, ValueError):
+        return False
+    return True
+
+
+class SignatureVerifier:
+    """
+    Verifies the signatures of transactions in batches, in a pool of
+    processes when a batch is large enough. The hashes of the
+    transactions whose signature is valid are cached, the hash covering
+    the signature, so a transaction verified when it entered the pool
+    is not verified again when it arrives in a block.
+    :param workers: Number of verification processes.
+    :param threshold: Number of signatures below which they are verified
+                      in the current process.
+    :param cache_size: Maximum number of cached transaction hashes, the
+                       least recently used are dropped first.
+    """
+
+    def __init__(self, workers=None, threshold=64, cache_size=100000):
+        self.workers = workers
+        self.threshold = threshold
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def verify_many(self, transactions):
+        """
+        Returns for each transaction whether its signature is valid.
+        """
+        results = [True] * len(transactions)
+        pending = []
+        with self._lock:
+            for position, transaction in enumerate(transactions):
+                tx_hash = transaction_hash(transaction)
+                if tx_hash in self._cache:
+                    self._cache.move_to_end(tx_hash)
+                else:
+                    pending.append((position, tx_hash))
+        if not pending:
+            return results
+
+        jobs = [transactions[position] for position, _ in pending]
+        if len(jobs) < self.threshold:
+            verified = map(verify_signature, jobs)
+        else:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(self.workers)
+            verified = self._pool.map(verify_signature, jobs, chunksize=32)
+
+        with self._lock:
+            for (position, tx_hash), valid in zip(pending, verified):
+                results[position] = valid
+                if valid:
+                    self._cache[tx_hash] = True
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("keygen", help="print a new private key and its address")
+    sign = subparsers.add_parser("sign", help="print a signed transaction for "
+                                              "/new_transaction")
+    sign.add_argument("--key", required=True, help="hex encoded private key")
+    sign.add_argument("--to", required=True, help="address of the recipient")
+    sign.add_argument("--amount", required=True)
+    sign.add_argument("--author", required=True)
+    args = parser.parse_args()
+
+    if args.command == "keygen":
+        private_key, address = generate_key()
+        print(json.dumps({"private_key": private_key, "address": address}))
+        return
+
+    address = public_address(args.key)
+    amount = float(args.amount)
+    # the fields the node derives from the content, see parse_transaction.
+    transaction = {"author": args.author,
+                   "content": "{},{},{}".format(address, args.to, args.amount),
+                   "timestamp": time.time(),
+                   "fromAddress": address,
+                   "toAddress": args.to,
+                   "amount": int(amount) if amount.is_integer() else amount}
+    print(json.dumps(sign_transaction(transaction, args.key)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Local network simulator.
+
+Starts a number of node_server.py nodes on localhost, each in its own
+process and working directory, connects them, and drives a synthetic
+load of transactions and mining requests against them. Every node adds
+the configured latency and drop rate to the requests it sends to its
+peers. At the end it reports the transaction throughput, the block
+propagation delays and the number of orphaned blocks:
+
+    $ python simulator.py --nodes 5 --duration 30 --tx-rate 20 --latency 0.05
+
+The propagation delay of a block is the time between its timestamp and
+the moment a node is seen with the block, nodes being polled every
+--poll-interval seconds. A block seen on some node but not part of the
+final chain is counted as orphaned.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from signatures import generate_key
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_node(args):
+    """
+    Entry point of a node process.
+    """
+    os.chdir(args.workdir)
+    sys.path.insert(0, HERE)
+    import node_server
+
+    node_server.transport.latency = args.latency
+    node_server.transport.jitter = args.jitter
+    node_server.transport.drop_rate = args.drop_rate
+    node_server.Blockchain.consensus = args.consensus
+    node_server.Blockchain.poet_mean_wait = args.poet_mean_wait
+    node_server.app.run(host="127.0.0.1", port=args.port, threaded=True)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Simulation:
+    """
+    A network of local node processes and the load driven against it.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.addresses = ["http://127.0.0.1:{}/".format(args.base_port + i)
+                          for i in range(args.nodes)]
+        self.processes = []
+        self.workdir = tempfile.mkdtemp(prefix="bct-sim-")
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        # block hash -> {"timestamp": block timestamp, "seen": {node: time}}
+        self.blocks = {}
+        self.submitted = 0
+        self.accepted = 0
+        self.mine_requests = 0
+
+    def start(self):
+        # every node is a registered proof of elapsed time miner.
+        keys = [generate_key() for _ in self.addresses]
+        miners = "".join(address + "\n" for _, address in keys)
+
+        for port_offset, address in enumerate(self.addresses):
+            workdir = os.path.join(self.workdir, str(port_offset))
+            os.makedirs(workdir)
+            private_key, node_address = keys[port_offset]
+            with open(os.path.join(workdir, "node_key"), "w") as node_key_file:
+                json.dump({"private_key": private_key, "address": node_address},
+                          node_key_file)
+            with open(os.path.join(workdir, "poet_miners"), "w") as miners_file:
+                miners_file.write(miners)
+            command = [sys.executable, os.path.abspath(__file__), "node",
+                       "--port", str(self.args.base_port + port_offset),
+                       "--workdir", workdir,
+                       "--latency", str(self.args.latency),
+                       "--jitter", str(self.args.jitter),
+                       "--drop-rate", str(self.args.drop_rate),
+                       "--consensus", self.args.consensus,
+                       "--poet-mean-wait", str(self.args.poet_mean_wait)]
+            self.processes.append(subprocess.Popen(command,
+                                                   stdout=subprocess.DEVNULL,
+                                                   stderr=subprocess.DEVNULL))
+
+        for address in self.addresses:
+            self._wait_ready(address)
+
+        # every node registers with a random node started before it.
+        for i, address in enumerate(self.addresses[1:], 1):
+            target = self.addresses[random.randrange(i)].rstrip("/")
+            self.session.post(address + "register_with",
+                              json={"node_address": target}, timeout=30)
+
+    def _wait_ready(self, address, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                self.session.get(address + "tip", timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError("node {} did not start".format(address))
+
+    def shutdown(self):
+        self.stop.set()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def submit_transactions(self):
+        interval = 1.0 / self.args.tx_rate
+        sequence = 0
+        while not self.stop.is_set():
+            sequence += 1
+            node = random.choice(self.addresses)
+            content = "addr{},addr{},{}".format(random.randrange(100),
+                                                random.randrange(100), sequence)
+            try:
+                response = self.session.post(node + "new_transaction",
+                                             json={"author": "simulator",
+                                                   "content": content},
+                                             timeout=5)
+                accepted = response.status_code == 201
+            except requests.RequestException:
+                accepted = False
+            with self.lock:
+                self.submitted += 1
+                self.accepted += accepted
+            self.stop.wait(interval)
+
+    def trigger_mining(self):
+        # every node is asked to mine on average every mine_interval seconds.
+        def mine(node):
+            try:
+                requests.get(node + "mine", timeout=120)
+            except requests.RequestException:
+                pass
+
+        while not self.stop.wait(self.args.mine_interval / self.args.nodes):
+            with self.lock:
+                self.mine_requests += 1
+            threading.Thread(target=mine, args=(random.choice(self.addresses),),
+                             daemon=True).start()
+
+    def poll(self):
+        """
+        Records when each block is first seen on each node.
+        """
+        known = {address: 0 for address in self.addresses}
+        while not self.stop.wait(self.args.poll_interval):
+            for address in self.addresses:
+                self._poll_node(address, known)
+
+    def _poll_node(self, address, known):
+        try:
+            start = max(known[address] - 2, 0)
+            headers = self.session.get(address + "headers",
+                                       params={"from": start},
+                                       timeout=5).json()["headers"]
+        except (requests.RequestException, ValueError):
+            return
+        now = time.time()
+        with self.lock:
+            for header in headers:
+                entry = self.blocks.setdefault(header["hash"],
+                                               {"timestamp": header["timestamp"],
+                                                "index": header["index"],
+                                                "seen": {}})
+                entry["seen"].setdefault(address, now)
+        known[address] = start + len(headers)
+
+    def run(self):
+        threads = [threading.Thread(target=self.submit_transactions, daemon=True),
+                   threading.Thread(target=self.trigger_mining, daemon=True),
+                   threading.Thread(target=self.poll, daemon=True)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        time.sleep(self.args.duration)
+        self.stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        # let the last blocks propagate before looking at the final chain.
+        time.sleep(self.args.settle)
+        known = {address: 0 for address in self.addresses}
+        for address in self.addresses:
+            self._poll_node(address, known)
+        return self.report(elapsed)
+
+    def final_chain(self):
+        """
+        Returns the chain of the nodes with the most work, and the number
+        of nodes that have it as their tip.
+        """
+        tips = {}
+        for address in self.addresses:
+            try:
+                tips[address] = self.session.get(address + "tip", timeout=5).json()
+            except (requests.RequestException, ValueError):
+                continue
+        address, best = max(tips.items(), key=lambda item: item[1]["work"])
+        agreeing = sum(1 for tip in tips.values() if tip["hash"] == best["hash"])
+
+        blocks = []
+        while len(blocks) < best["length"]:
+            page = self.session.get(address + "blocks",
+                                    params={"from": len(blocks)},
+                                    timeout=30).json()["blocks"]
+            if not page:
+                break
+            blocks.extend(page)
+        return blocks, agreeing
+
+    def report(self, elapsed):
+        chain, agreeing = self.final_chain()
+        chain_hashes = {block["hash"] for block in chain}
+        confirmed = sum(len(block["transactions"]) for block in chain)
+
+        delays = []
+        for block_hash in chain_hashes:
+            entry = self.blocks.get(block_hash)
+            if entry is None or entry["index"] == 0:
+                continue
+            delays.extend(seen - entry["timestamp"] for seen in entry["seen"].values())
+
+        orphans = [block_hash for block_hash, entry in self.blocks.items()
+                   if block_hash not in chain_hashes]
+        return {"nodes": self.args.nodes,
+                "consensus": self.args.consensus,
+                "duration": elapsed,
+                "latency": self.args.latency,
+                "jitter": self.args.jitter,
+                "drop_rate": self.args.drop_rate,
+                "transactions_submitted": self.submitted,
+                "transactions_accepted": self.accepted,
+                "transactions_confirmed": confirmed,
+                "tps": confirmed / elapsed,
+                "mine_requests": self.mine_requests,
+                "chain_length": len(chain),
+                "blocks_seen": len(self.blocks),
+                "orphans": len(orphans),
+                "nodes_on_best_tip": agreeing,
+                "propagation": {"p50": percentile(delays, 0.5),
+                                "p90": percentile(delays, 0.9),
+                                "p99": percentile(delays, 0.99),
+                                "max": max(delays) if delays else None}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command")
+
+    node = subparsers.add_parser("node", help="run a single node (internal)")
+    node.add_argument("--port", type=int, required=True)
+    node.add_argument("--workdir", required=True)
+
+    for arguments in (parser, node):
+        arguments.add_argument("--latency", type=float, default=0.0,
+                               help="delay added to every peer request, in seconds")
+        arguments.add_argument("--jitter", type=float, default=0.0,
+                               help="random extra delay of up to this many seconds")
+        arguments.add_argument("--drop-rate", type=float, default=0.0,
+                               help="probability that a peer request is dropped")
+        arguments.add_argument("--consensus", choices=("pow", "poet"), default="pow")
+        arguments.add_argument("--poet-mean-wait", type=float, default=1.0,
+                               help="mean wait of proof of elapsed time, in seconds")
+
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--base-port", type=int, default=9000)
+    parser.add_argument("--duration", type=float, default=20.0,
+                        help="how long the load is driven, in seconds")
+    parser.add_argument("--tx-rate", type=float, default=10.0,
+                        help="transactions submitted per second")
+    parser.add_argument("--mine-interval", type=float, default=2.0,
+                        help="average time between mining requests to a node")
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--settle", type=float, default=3.0,
+                        help="time given to the network to converge at the end")
+    parser.add_argument("--output", default="-",
+                        help="file to write the JSON report to, - for stdout")
+    args = parser.parse_args()
+
+    if args.command == "node":
+        run_node(args)
+        return
+
+    simulation = Simulation(args)
+    try:
+        simulation.start()
+        report = simulation.run()
+    finally:
+        simulation.shutdown()
+
+    output = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+
+
+if __name__ == "__main__":
+    main()
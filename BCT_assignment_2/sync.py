@@ -0,0 +1,243 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import requests
+
+from block import block_from_dict, block_with_hash, decode_target, header_hash
+from mining import difficulty_to_target
+from poet import is_valid_certificate
+
+
+def _verify_block(args):
+    """
+    Entry point of a verification process, checks the proof of a block
+    given as its JSON representation against its own target, or the
+    default target if it has none, or its wait certificate.
+    """
+    block_data, default_target, mean_wait, miners = args
+    block = block_from_dict(block_data)
+    if block.certificate is not None:
+        return block.has_valid_certificate(block_data["hash"], mean_wait, miners)
+    target = block.target if block.target is not None else default_target
+    return block.has_valid_proof(block_data["hash"], target)
+
+
+class ChainSync:
+    """
+    Headers-first synchronisation of a blockchain with its peers.
+    1. The tips of all peers are fetched and the chain with the most
+       work is picked.
+    2. Its headers after the point where it forks from our chain are
+       downloaded and their links are checked.
+    3. The block bodies are downloaded in batches, in parallel from all
+       the peers which still have them, and each body must match its
+       header. The batches are streamed and checked block by block as
+       they arrive. Pruned peers only serve the bodies from the
+       `pruned_height` of their tip onwards, archival peers all of them.
+    4. The proofs of the blocks are verified in a pool of processes.
+    Only then the blocks replace our chain after the fork point.
+    :param blockchain: The `Blockchain` to keep in sync.
+    :param transport: `PeerTransport` used to talk to the peers.
+    :param batch_size: Number of blocks downloaded per request.
+    :param download_workers: Number of concurrent requests.
+    :param verify_workers: Number of verification processes.
+    :param verify_threshold: Number of blocks below which the proofs are
+                             verified in the current process.
+    """
+
+    def __init__(self, blockchain, transport, batch_size=100,
+                 download_workers=8, verify_workers=None, verify_threshold=64):
+        self.blockchain = blockchain
+        self.transport = transport
+        self.batch_size = batch_size
+        self.download_workers = download_workers
+        self.verify_workers = verify_workers
+        self.verify_threshold = verify_threshold
+        self._verify_pool = None
+
+    def _get(self, peer, path, params=None):
+        return self.transport.get_json(peer, path, params)
+
+    def sync(self, peers):
+        """
+        Brings our chain up to the valid chain of the peers with the
+        most work.
+        Returns True if our chain has been replaced.
+        """
+        peers = list(peers)
+        if not peers:
+            return False
+
+        tips = [(peer, tip) for peer, tip in self.transport.get_many(peers, 'tip')
+                if tip is not None]
+        tips.sort(key=lambda item: item[1].get('work', 0), reverse=True)
+
+        for peer, tip in tips:
+            if tip.get('work', 0) <= self.blockchain.snapshot.work:
+                break
+            try:
+                if self._sync_from(peer, tip['length'],
+                                   {p: t.get('pruned_height', 0) for p, t in tips}):
+                    return True
+            except (requests.RequestException, ValueError, KeyError, TypeError):
+                continue
+        return False
+
+    def _sync_from(self, peer, length, peers):
+        start = self.find_fork_point(peer, length)
+        if start == 0 or start <= self.blockchain.pruned_height:
+            # the genesis block is different, or we pruned the blocks
+            # the peer's chain would replace, see `replace_suffix`.
+            return False
+
+        headers = self.fetch_headers(peer, start, length)
+        if not self.check_headers(start, headers):
+            return False
+
+        block_list = self.fetch_bodies(peers, start, headers)
+        if block_list is None:
+            return False
+        blocks = self.verify_proofs(block_list)
+        if blocks is None:
+            return False
+
+        if not self.blockchain.check_suffix_validity(start, blocks,
+                                                     check_proofs=False):
+            return False
+        # our chain may have grown while the blocks were downloaded.
+        return self.blockchain.replace_suffix(start, blocks)
+
+    def find_fork_point(self, peer, length):
+        """
+        Returns how many blocks at the start of the peer's chain are the
+        same as in our chain, found with a binary search on its headers.
+        """
+        def peer_hash(height):
+            headers = self._get(peer, 'headers', {"from": height, "count": 1})['headers']
+            # the peer may have lost blocks since it sent its tip.
+            if not headers:
+                raise ValueError("peer has no header at height {}".format(height))
+            return headers[0]['hash']
+
+        def our_hash(height):
+            block = self.blockchain.block_at(height)
+            return block.hash if block is not None else None
+
+        low, high = 0, min(length, self.blockchain.snapshot.length)
+        # most of the time the peer simply extends our chain.
+        if high and peer_hash(high - 1) == our_hash(high - 1):
+            return high
+        while low < high:
+            middle = (low + high + 1) // 2
+            if peer_hash(middle - 1) == our_hash(middle - 1):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def fetch_headers(self, peer, start, end):
+        """
+        Downloads the headers with index in [start, end) from the peer.
+        """
+        headers = []
+        while start + len(headers) < end:
+            page = self._get(peer, 'headers',
+                             {"from": start + len(headers),
+                              "count": end - start - len(headers)})['headers']
+            if not page:
+                break
+            headers.extend(page)
+        return headers[:end - start]
+
+    def check_headers(self, start, headers):
+        """
+        Checks the links of the header chain. Headers committing to a
+        Merkle root are hashed as well, the hash of a plain block can
+        only be checked once its body is known.
+        """
+        default_target = difficulty_to_target(type(self.blockchain).difficulty)
+        mean_wait = type(self.blockchain).poet_mean_wait
+        miners = type(self.blockchain).poet_miners
+        previous = self.blockchain.block_at(start - 1)
+        if previous is None:
+            return False
+        previous_hash = previous.hash
+        for height, header in enumerate(headers, start):
+            if header['index'] != height or header['previous_hash'] != previous_hash:
+                return False
+            if 'certificate' in header:
+                if not is_valid_certificate(header['certificate'],
+                                            header['previous_hash'], mean_wait,
+                                            miners):
+                    return False
+            elif int(header['hash'], 16) >= (decode_target(header.get('target')) or
+                                             default_target):
+                return False
+            if 'merkle_root' in header and header_hash(header) != header['hash']:
+                return False
+            previous_hash = header['hash']
+        return True
+
+    def fetch_bodies(self, peers, start, headers):
+        """
+        Downloads the blocks of the headers in batches spread over the
+        peers. A batch which does not match the headers is requested
+        again from the next peer. Returns None if a batch could not be
+        downloaded from any peer.
+        :param peers: The pruned height of every peer, a batch is only
+                      requested from the peers which have its bodies.
+        """
+        batches = [(offset, min(offset + self.batch_size, len(headers)))
+                   for offset in range(0, len(headers), self.batch_size)]
+
+        def download(job):
+            number, (first, last) = job
+            serving = [peer for peer, pruned_height in peers.items()
+                       if pruned_height <= start + first]
+            for attempt in range(len(serving)):
+                peer = serving[(number + attempt) % len(serving)]
+                expected = headers[first:last]
+                block_list = []
+                try:
+                    for block_data in self.transport.iter_json_lines(
+                            peer, 'blocks', {"from": start + first,
+                                             "to": start + last}):
+                        if (len(block_list) == len(expected) or
+                                block_data.get('pruned') or
+                                block_data['hash'] != expected[len(block_list)]['hash']):
+                            break
+                        block_list.append(block_data)
+                except (requests.RequestException, ValueError, KeyError, TypeError):
+                    continue
+                if len(block_list) == len(expected):
+                    return block_list
+            return None
+
+        with ThreadPoolExecutor(self.download_workers) as pool:
+            results = list(pool.map(download, enumerate(batches)))
+        if any(result is None for result in results):
+            return None
+        return [block_data for result in results for block_data in result]
+
+    def verify_proofs(self, block_list):
+        """
+        Verifies the proofs of the downloaded blocks, in a pool of
+        processes when there are enough of them, and converts them to
+        blocks. Returns the blocks, or None if a proof is invalid.
+        """
+        blocks = [block_with_hash(block_data) for block_data in block_list]
+        default_target = difficulty_to_target(type(self.blockchain).difficulty)
+        mean_wait = type(self.blockchain).poet_mean_wait
+        miners = type(self.blockchain).poet_miners
+        jobs = [(block_data, default_target, mean_wait, miners)
+                for block_data in block_list]
+
+        if len(jobs) < self.verify_threshold:
+            results = map(_verify_block, jobs)
+        else:
+            if self._verify_pool is None:
+                self._verify_pool = ProcessPoolExecutor(self.verify_workers)
+            results = self._verify_pool.map(_verify_block, jobs, chunksize=32)
+
+        if not all(results):
+            return None
+        return blocks
@@ -0,0 +1,113 @@
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from json_stream import NDJSON_MIMETYPE, iter_ndjson
+
+
+class PeerTransport:
+    """
+    HTTP client used to talk to the peers.
+    Connections are kept alive and reused through a pooled session, every
+    request has a timeout, and requests to several peers are sent
+    concurrently from a bounded pool of threads, so one slow or dead
+    peer does not hold up the others.
+    :param timeout: Timeout of a single request, in seconds.
+    :param workers: Maximum number of concurrent requests.
+    :param fanout: Maximum number of peers a message is gossiped to,
+                   None to send it to every peer.
+    The `latency`, `jitter` and `drop_rate` attributes simulate a slower
+    or lossy network, see simulator.py: every request is delayed by
+    latency plus a random part of jitter seconds, and is dropped with
+    probability drop_rate.
+    """
+
+    def __init__(self, timeout=5, workers=16, fanout=8):
+        self.timeout = timeout
+        self.fanout = fanout
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.drop_rate = 0.0
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._pool = ThreadPoolExecutor(workers)
+
+    def _simulate_network(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+        if self.drop_rate and random.random() < self.drop_rate:
+            raise requests.ConnectionError("request dropped by the simulator")
+
+    def get_json(self, peer, path, params=None):
+        """
+        Sends a GET request to the peer and returns the decoded JSON.
+        Raises `requests.RequestException` or `ValueError` on failure.
+        """
+        self._simulate_network()
+        response = self.session.get('{}{}'.format(peer, path), params=params,
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def iter_json_lines(self, peer, path, params=None):
+        """
+        Sends a GET request for newline-delimited JSON to the peer and
+        yields the decoded values as they are downloaded.
+        Raises `requests.RequestException` or `ValueError` on failure.
+        """
+        self._simulate_network()
+        with self.session.get('{}{}'.format(peer, path), params=params,
+                              headers={'Accept': NDJSON_MIMETYPE},
+                              timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            if response.headers.get('Content-Type', '').split(';')[0] != NDJSON_MIMETYPE:
+                raise ValueError("The peer did not answer with NDJSON")
+            yield from iter_ndjson(response.iter_content(64 * 1024))
+
+    def post_json(self, peer, path, data):
+        """
+        Sends `data` as JSON to the peer and returns the response.
+        """
+        self._simulate_network()
+        return self.session.post('{}{}'.format(peer, path),
+                                 data=json.dumps(data, sort_keys=True),
+                                 headers={'Content-Type': "application/json"},
+                                 timeout=self.timeout)
+
+    def get_many(self, peers, path, params=None):
+        """
+        Sends the same GET request to all peers concurrently. Returns a
+        list of (peer, decoded JSON) pairs, the JSON is None for the
+        peers which failed to answer.
+        """
+        def get(peer):
+            try:
+                return peer, self.get_json(peer, path, params)
+            except (requests.RequestException, ValueError):
+                return peer, None
+
+        return list(self._pool.map(get, list(peers)))
+
+    def pick_fanout(self, peers, exclude=None):
+        """
+        Returns at most `fanout` random peers, without `exclude`.
+        """
+        candidates = [peer for peer in peers if peer != exclude]
+        if self.fanout is None or len(candidates) <= self.fanout:
+            return candidates
+        return random.sample(candidates, self.fanout)
+
+    def gossip(self, peers, function, *args, exclude=None):
+        """
+        Calls `function(peer, *args)` in the background for a random
+        subset of at most `fanout` peers, for exchanges which take more
+        than one request. Returns the futures of the calls.
+        """
+        return [self._pool.submit(function, peer, *args)
+                for peer in self.pick_fanout(peers, exclude)]
@@ -0,0 +1,38 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional, responses are compressed with gzip without it.
+    zstandard = None
+
+
+def content_encodings():
+    """
+    The content encodings responses can be compressed with, the
+    preferred one first.
+    """
+    if zstandard is not None:
+        return ["zstd", "gzip"]
+    return ["gzip"]
+
+
+def _compressor(encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    if encoding == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    raise ValueError("Unknown content encoding {}".format(encoding))
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compresses an iterable of byte chunks with the content encoding,
+    as the chunks are produced, so a streamed response stays streamed.
+    """
+    compressor = _compressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
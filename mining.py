@@ -0,0 +1,175 @@
+import json
+import multiprocessing
+import os
+import time
+from hashlib import sha256
+
+
+# placeholder put in the nonce field while the block template is serialized.
+# It is replaced by the real nonce bytes on every attempt.
+NONCE_PLACEHOLDER = "__nonce_placeholder__"
+
+# how many nonces a worker tries before checking if someone else has won.
+CHECK_INTERVAL = 4096
+
+
+def difficulty_to_target(difficulty):
+    """
+    Converts the "number of leading zeros" difficulty into an integer
+    target. A hash satisfies the difficulty when its integer value is
+    lower than the target.
+    :param difficulty: Number of leading hex zeros required.
+    """
+    return 1 << (256 - 4 * difficulty)
+
+
+def split_block_template(block):
+    """
+    Serializes the block once and splits the result around the nonce,
+    so the hash of any nonce is sha256(prefix + str(nonce) + suffix).
+    The block must provide a `serialize` method returning exactly the
+    string that its `compute_hash` hashes.
+    :param block: Block to be mined.
+    """
+    nonce = block.nonce
+    block.nonce = NONCE_PLACEHOLDER
+    try:
+        block_string = block.serialize()
+    finally:
+        block.nonce = nonce
+
+    marker = json.dumps(NONCE_PLACEHOLDER)
+    if block_string.count(marker) != 1:
+        raise ValueError("Can not locate the nonce in the block template")
+
+    prefix, suffix = block_string.split(marker)
+    return prefix.encode(), suffix.encode()
+
+
+def search_nonce(prefix, suffix, target, start, step, stop_event=None):
+    """
+    Tries nonces start, start + step, start + 2 * step, ... until one of
+    them hashes below the target.
+    The SHA-256 state of the prefix is computed once and copied for every
+    attempt, so only the nonce and the suffix are hashed again.
+    Returns a tuple (nonce, hashes tried), nonce is None if the search
+    was stopped before a valid nonce was found.
+    """
+    midstate = sha256(prefix)
+    nonce = start
+    hashes = 0
+    while True:
+        for _ in range(CHECK_INTERVAL):
+            attempt = midstate.copy()
+            attempt.update(str(nonce).encode())
+            attempt.update(suffix)
+            hashes += 1
+            if int.from_bytes(attempt.digest(), "big") < target:
+                return nonce, hashes
+            nonce += step
+
+        if stop_event is not None and stop_event.is_set():
+            return None, hashes
+
+
+def _worker(prefix, suffix, target, start, step, stop_event, results):
+    """
+    Entry point of a mining process. Puts (nonce, hashes) in the
+    results queue when it stops.
+    """
+    nonce, hashes = search_nonce(prefix, suffix, target, start, step,
+                                 stop_event)
+    if nonce is not None:
+        stop_event.set()
+    results.put((nonce, hashes))
+
+
+class ProofOfWorkEngine:
+    """
+    Mining engine used by `Blockchain.proof_of_work`.
+    The block header is serialized only once per block, and the nonce
+    space is split across a pool of processes which all stop as soon as
+    one of them finds a valid nonce. Blocks which are expected to be
+    solved in less than `parallel_threshold` hashes are mined in the
+    current process, as starting the pool would cost more than mining.
+    :param workers: Number of mining processes, defaults to the CPU count.
+    :param parallel_threshold: Expected hashes below which no pool is used.
+    """
+
+    def __init__(self, workers=None, parallel_threshold=1 << 20):
+        self.workers = workers or os.cpu_count() or 1
+        self.parallel_threshold = parallel_threshold
+        self.last_hashes = 0
+        self.last_elapsed = 0.0
+
+    @property
+    def hashrate(self):
+        """
+        Hashes per second achieved by the last call to `solve`.
+        """
+        if not self.last_elapsed:
+            return 0.0
+        return self.last_hashes / self.last_elapsed
+
+    def stats(self):
+        return {"hashes": self.last_hashes,
+                "elapsed": self.last_elapsed,
+                "hashrate": self.hashrate,
+                "workers": self.workers}
+
+    def solve(self, block, difficulty):
+        """
+        Finds a nonce for the block that satisfies the difficulty.
+        Sets `block.nonce` and returns the hash of the block, which is
+        the same value `block.compute_hash()` would return.
+        :param block: Block to be mined.
+        :param difficulty: Number of leading hex zeros required.
+        """
+        prefix, suffix = split_block_template(block)
+        target = difficulty_to_target(difficulty)
+
+        started = time.perf_counter()
+        if self.workers == 1 or 16 ** difficulty < self.parallel_threshold:
+            nonce, hashes = search_nonce(prefix, suffix, target, 0, 1)
+        else:
+            nonce, hashes = self._solve_parallel(prefix, suffix, target)
+        self.last_elapsed = time.perf_counter() - started
+        self.last_hashes = hashes
+
+        block.nonce = nonce
+        return sha256(prefix + str(nonce).encode() + suffix).hexdigest()
+
+    def _solve_parallel(self, prefix, suffix, target):
+        """
+        Worker i tries the nonces i, i + workers, i + 2 * workers, ...
+        Returns the winning nonce and the number of hashes of all workers.
+        """
+        context = multiprocessing.get_context()
+        stop_event = context.Event()
+        results = context.Queue()
+        processes = [
+            context.Process(target=_worker,
+                            args=(prefix, suffix, target, start,
+                                  self.workers, stop_event, results),
+                            daemon=True)
+            for start in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+
+        winners = []
+        hashes = 0
+        try:
+            for _ in processes:
+                nonce, worker_hashes = results.get()
+                hashes += worker_hashes
+                if nonce is not None:
+                    winners.append(nonce)
+        finally:
+            stop_event.set()
+            for process in processes:
+                process.join()
+
+        # more than one worker may win the same round, the lowest nonce
+        # is picked so the result does not depend on scheduling.
+        return min(winners), hashes